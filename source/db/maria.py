@@ -3,6 +3,9 @@ import pymysql
 from datetime import datetime
 import re
 import os
+import json
+import queue
+import threading
 # Database configuration
 
 DB_CONFIG = {
@@ -15,9 +18,60 @@ DB_CONFIG = {
 }
 
 # File path - relative to this script's location
-# Script is in DB/ folder, Excel file is in Data/ folder (both in same parent directory)
+# Script is in db/ folder, Excel file is in data/ folder (both in same parent directory)
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-EXCEL_FILE = os.path.join(SCRIPT_DIR, '..', 'Data', 'questions.xlsx')
+EXCEL_FILE = os.path.join(SCRIPT_DIR, '..', 'data', 'questions.xlsx')
+
+# Import mode: 'bulk' cleans whole columns and inserts chunks with executemany
+# (one multi-row INSERT per chunk, committed per chunk); 'stream' does the same
+# but reads the workbook chunk by chunk (openpyxl read-only) and can resume;
+# 'merge' loads the sheet into a staging table and merges it into questions in
+# one transaction, with a diff summary; 'rows' is the original row-by-row insert
+IMPORT_MODE = os.getenv('IMPORT_MODE') or 'bulk'
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE') or 1000)
+
+# Progress of a streaming import: last committed sheet row, for resuming after a failure
+IMPORT_CHECKPOINT = os.getenv('IMPORT_CHECKPOINT') or os.path.join(SCRIPT_DIR, '.import_checkpoint.json')
+
+# Cell strings pd.read_excel reads as missing (its default na_values), applied to streamed rows too
+EXCEL_NA_VALUES = {
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'
+}
+
+COLUMNS = ['id', 'title', 'content', 'date', 'post_type', 'langues', 'thematiques', 'utilisateurs', 'ecoles', 'status']
+
+# Excel header -> questions column, in COLUMNS order
+SHEET_COLUMNS = {
+    'id': 'id',
+    'Title': 'title',
+    'Content': 'content',
+    'Date': 'date',
+    'Post Type': 'post_type',
+    'Langues': 'langues',
+    'Thématiques': 'thematiques',
+    'Utilisateurs': 'utilisateurs',
+    'Écoles': 'ecoles',
+    'Status': 'status',
+}
+
+INSERT_SQL = """
+INSERT INTO questions 
+(id, title, content, date, post_type, langues, thematiques, utilisateurs, ecoles, status)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+UPSERT_SQL = INSERT_SQL + """ON DUPLICATE KEY UPDATE
+    title = VALUES(title),
+    content = VALUES(content),
+    date = VALUES(date),
+    post_type = VALUES(post_type),
+    langues = VALUES(langues),
+    thematiques = VALUES(thematiques),
+    utilisateurs = VALUES(utilisateurs),
+    ecoles = VALUES(ecoles),
+    status = VALUES(status)
+"""
 
 def create_table(cursor):
     """Create the questions table if it doesn't exist"""
@@ -34,13 +88,46 @@ def create_table(cursor):
         ecoles TEXT,
         status VARCHAR(50),
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
         INDEX idx_post_type (post_type),
         INDEX idx_status (status),
-        INDEX idx_langues (langues)
+        INDEX idx_langues (langues),
+        INDEX idx_updated_at (updated_at)
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
     """
     cursor.execute(create_table_sql)
     print("✓ Table 'questions' created/verified")
+    migrate_table(cursor)
+
+def migrate_table(cursor):
+    """Add columns introduced after the table was first created"""
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = 'questions' AND column_name = 'updated_at'
+    """)
+    if cursor.fetchone()[0] == 0:
+        # Used by the embeddings service's incremental /sync
+        cursor.execute("""
+            ALTER TABLE questions
+            ADD COLUMN updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            ADD INDEX idx_updated_at (updated_at)
+        """)
+        print("✓ Column 'updated_at' added to 'questions'")
+
+def create_changes_table(cursor):
+    """Create the question_changes table (ids touched by each merge import, for targeted reindexing)"""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS question_changes (
+        id INT PRIMARY KEY AUTO_INCREMENT,
+        import_id VARCHAR(32) NOT NULL,
+        question_id INT NOT NULL,
+        change_type VARCHAR(20) NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        INDEX idx_import_id (import_id),
+        INDEX idx_question_id (question_id)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    """)
+    print("✓ Table 'question_changes' created/verified")
 
 def clean_date(date_val):
     """Convert date to proper format"""
@@ -64,29 +151,11 @@ def insert_data(cursor, df, sheet_name, allow_updates=False):
     """
     if allow_updates:
         # Original behavior: update if exists
-        insert_sql = """
-        INSERT INTO questions 
-        (id, title, content, date, post_type, langues, thematiques, utilisateurs, ecoles, status)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ON DUPLICATE KEY UPDATE
-            title = VALUES(title),
-            content = VALUES(content),
-            date = VALUES(date),
-            post_type = VALUES(post_type),
-            langues = VALUES(langues),
-            thematiques = VALUES(thematiques),
-            utilisateurs = VALUES(utilisateurs),
-            ecoles = VALUES(ecoles),
-            status = VALUES(status)
-        """
+        insert_sql = UPSERT_SQL
     else:
         # Safer behavior: error on duplicate (prevents overwrites)
         # If ID is NULL, auto-increment will assign it
-        insert_sql = """
-        INSERT INTO questions 
-        (id, title, content, date, post_type, langues, thematiques, utilisateurs, ecoles, status)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
+        insert_sql = INSERT_SQL
     
     inserted = 0
     updated = 0
@@ -130,6 +199,419 @@ def insert_data(cursor, df, sheet_name, allow_updates=False):
     
     return inserted, updated, errors
 
+def clean_dates(values):
+    """clean_date over a whole column: NaN/unparseable -> None, 'YYYY-MM-DD' strings and dates -> date"""
+    parsed = pd.to_datetime(values, format='%Y-%m-%d', errors='coerce')
+    return parsed.dt.date.astype(object).where(parsed.notna(), None)
+
+def clean_frame(df):
+    """Column-wise cleaning of a sheet into rows ready for INSERT_SQL (same values as insert_data builds)
+    
+    Only a missing id becomes None (auto-increment); a row whose id is not a
+    number is left out and reported, as insert_data would fail on it.
+    
+    Returns:
+        (rows, invalid) - invalid lists (row label, id cell) of the rows left out
+    """
+    clean = pd.DataFrame(index=df.index)
+    valid = None
+    invalid = []
+    for header, column in SHEET_COLUMNS.items():
+        values = df[header]
+        if column == 'id':
+            ids = pd.to_numeric(values, errors='coerce')
+            valid = ids.notna() | values.isna()
+            invalid = list(values[~valid].items())
+            clean[column] = pd.Series([None if pd.isna(v) else int(v) for v in ids], index=df.index, dtype=object)
+        elif column == 'date':
+            clean[column] = clean_dates(values)
+        else:
+            clean[column] = values.astype(str).astype(object).where(values.notna(), None)
+    rows = clean[COLUMNS].itertuples(index=False, name=None)
+    return [row for row, keep in zip(rows, valid) if keep], invalid
+
+def report_invalid_ids(invalid):
+    """Print the rows clean_frame left out; returns how many errors they count for"""
+    for idx, value in invalid:
+        print(f"  ✗ Error on row {idx} (ID: {value}): id is not a number")
+    return len(invalid)
+
+def existing_ids(cursor, ids):
+    """Subset of ids already present in questions"""
+    if not ids:
+        return set()
+    placeholders = ', '.join(['%s'] * len(ids))
+    cursor.execute(f"SELECT id FROM questions WHERE id IN ({placeholders})", list(ids))
+    return {row[0] for row in cursor.fetchall()}
+
+def insert_chunk(cursor, rows, allow_updates=False):
+    """Insert one chunk of cleaned rows with a single executemany (multi-row INSERT)
+    
+    Without allow_updates, rows whose id already exists (in the table or earlier
+    in the chunk) are skipped and counted as duplicates instead of failing the chunk.
+    
+    Returns:
+        (inserted, updated, duplicates)
+    """
+    ids = [row[0] for row in rows if row[0] is not None]
+    existing = existing_ids(cursor, set(ids))
+
+    if allow_updates:
+        if not rows:
+            return 0, 0, 0
+        cursor.executemany(UPSERT_SQL, rows)
+        # Affected rows: 1 per insert, 2 per changed update, 0 per identical row
+        inserted = sum(1 for row in rows if row[0] is None or row[0] not in existing)
+        updated = max(cursor.rowcount - inserted, 0) // 2
+        return inserted, updated, 0
+
+    seen = set(existing)
+    fresh = []
+    for row in rows:
+        if row[0] is not None:
+            if row[0] in seen:
+                continue
+            seen.add(row[0])
+        fresh.append(row)
+    if fresh:
+        cursor.executemany(INSERT_SQL, fresh)
+    return len(fresh), 0, len(rows) - len(fresh)
+
+def insert_data_bulk(connection, cursor, df, allow_updates=False, chunk_size=IMPORT_CHUNK_SIZE):
+    """Bulk counterpart of insert_data: vectorized cleaning, chunked executemany, one commit per chunk
+    
+    A chunk that fails is rolled back and replayed row by row with insert_data,
+    so one bad row only costs its own insert.
+    
+    Returns:
+        (inserted, updated, errors, duplicates)
+    """
+    inserted = updated = errors = duplicates = 0
+
+    for start in range(0, len(df), chunk_size):
+        part = df.iloc[start:start + chunk_size]
+        label = f"rows {start + 1}-{start + len(part)}"
+        chunk, invalid = clean_frame(part)
+        try:
+            chunk_inserted, chunk_updated, chunk_duplicates = insert_chunk(cursor, chunk, allow_updates)
+            connection.commit()
+            errors += report_invalid_ids(invalid)
+        except Exception as e:
+            connection.rollback()
+            print(f"  ✗ Chunk {label} failed ({str(e)}), retrying row by row")
+            # insert_data reports the invalid ids of the chunk itself
+            chunk_inserted, chunk_updated, chunk_errors = insert_data(
+                cursor, part, label, allow_updates=allow_updates
+            )
+            connection.commit()
+            chunk_duplicates = 0
+            errors += chunk_errors
+
+        inserted += chunk_inserted
+        updated += chunk_updated
+        duplicates += chunk_duplicates
+        print(f"  ✓ Chunk {label}: inserted {chunk_inserted} | updated {chunk_updated} | duplicates {chunk_duplicates}")
+
+    return inserted, updated, errors, duplicates
+
+def file_signature(path):
+    """Identifies one version of the workbook, so a checkpoint is never applied to another export"""
+    stat = os.stat(path)
+    return {'file': os.path.abspath(path), 'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+def load_checkpoint(path, checkpoint_file=IMPORT_CHECKPOINT):
+    """Sheet row to resume after (0 = start from the top)"""
+    try:
+        with open(checkpoint_file, encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    if checkpoint.get('source') != file_signature(path):
+        return 0
+    return int(checkpoint.get('row', 0))
+
+def save_checkpoint(path, row, checkpoint_file=IMPORT_CHECKPOINT):
+    tmp = checkpoint_file + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'source': file_signature(path), 'row': row}, f)
+    os.replace(tmp, checkpoint_file)
+
+def clear_checkpoint(checkpoint_file=IMPORT_CHECKPOINT):
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
+def read_excel_chunks(path, chunk_size=IMPORT_CHUNK_SIZE, skip_rows=0):
+    """Stream the first sheet as DataFrames of at most chunk_size rows (openpyxl read-only mode)
+    
+    Only the current chunk is held in memory. Rows are counted from the first
+    data row under the header; the first skip_rows are skipped (resume).
+    
+    Yields:
+        (df, last_row) - last_row is the sheet row the chunk ends on, for checkpoints
+    """
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        rows = sheet.iter_rows(values_only=True)
+        header = [str(h).strip() if h is not None else '' for h in next(rows, [])]
+        missing = [h for h in SHEET_COLUMNS if h not in header]
+        if missing:
+            raise ValueError(f"Missing columns in {os.path.basename(path)}: {', '.join(missing)}")
+
+        chunk = []
+        row_number = 0
+        for values in rows:
+            row_number += 1
+            if row_number <= skip_rows:
+                continue
+            if all(v is None for v in values):
+                continue
+            chunk.append([None if isinstance(v, str) and v in EXCEL_NA_VALUES else v for v in values])
+            if len(chunk) >= chunk_size:
+                yield pd.DataFrame(chunk, columns=header), row_number
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=header), row_number
+    finally:
+        workbook.close()
+
+class _PrefetchFailure:
+    def __init__(self, error):
+        self.error = error
+
+def prefetch(chunks, depth=1):
+    """Parse the next chunk(s) in a background thread while the current one is inserted
+    
+    Same helper as embeddings_exposer.prefetch (the db scripts don't import the
+    embeddings service). The queue is bounded, so at most depth chunks wait in
+    memory; every put gives up once the consumer has stopped, and the chunk
+    generator is closed with the producer, so the workbook never stays open.
+    """
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in chunks:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_PrefetchFailure(e))
+        finally:
+            put(done)
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                return
+            if isinstance(item, _PrefetchFailure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+def insert_data_stream(connection, cursor, path, allow_updates=False, chunk_size=IMPORT_CHUNK_SIZE,
+                       checkpoint_file=IMPORT_CHECKPOINT):
+    """Streaming import: read, clean and insert the workbook chunk by chunk, one commit per chunk
+    
+    After each commit the sheet row reached is checkpointed; a rerun on the
+    same file resumes after it. A failing chunk is rolled back and stops the
+    import (the checkpoint still points at the last committed chunk). The
+    checkpoint is removed once the whole sheet is loaded.
+    
+    Returns:
+        (inserted, updated, errors, duplicates)
+    """
+    start_row = load_checkpoint(path, checkpoint_file)
+    if start_row:
+        print(f"  → Resuming after sheet row {start_row} (checkpoint {os.path.basename(checkpoint_file)})")
+
+    inserted = updated = errors = duplicates = 0
+    first_row = start_row + 1
+
+    for df, last_row in prefetch(read_excel_chunks(path, chunk_size, skip_rows=start_row)):
+        label = f"rows {first_row}-{last_row}"
+        rows, invalid = clean_frame(df)
+        try:
+            chunk_inserted, chunk_updated, chunk_duplicates = insert_chunk(cursor, rows, allow_updates)
+            connection.commit()
+        except Exception as e:
+            connection.rollback()
+            print(f"  ✗ Chunk {label} failed: {str(e)}")
+            print(f"  → Rerun to resume after sheet row {first_row - 1}")
+            raise
+
+        save_checkpoint(path, last_row, checkpoint_file)
+        errors += report_invalid_ids(invalid)
+        inserted += chunk_inserted
+        updated += chunk_updated
+        duplicates += chunk_duplicates
+        first_row = last_row + 1
+        print(f"  ✓ Chunk {label}: inserted {chunk_inserted} | updated {chunk_updated} | duplicates {chunk_duplicates}")
+
+    clear_checkpoint(checkpoint_file)
+    return inserted, updated, errors, duplicates
+
+STAGING_TABLE = 'questions_staging'
+
+# Null-safe "row differs" test between questions (q) and the staging table (s).
+# Compared as bytes: utf8mb4_unicode_ci would call 'Reussir' = 'Réussir' and ignore case and trailing spaces
+ROW_DIFFERS = ' OR '.join(f"NOT (BINARY q.{c} <=> BINARY s.{c})" for c in COLUMNS[1:])
+
+def load_staging(cursor, path, chunk_size=IMPORT_CHUNK_SIZE):
+    """Stream the workbook into a session-private staging table shaped like questions
+    
+    Rows without an id cannot be matched against questions: they are
+    returned as-is, to be inserted as new rows. For an id repeated in the
+    sheet the first occurrence wins, as with insert_data. Rows whose id is
+    not a number are reported and left out.
+    
+    Returns:
+        (loaded, duplicates, rows_without_id, invalid)
+    """
+    cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS {STAGING_TABLE}")
+    cursor.execute(f"CREATE TEMPORARY TABLE {STAGING_TABLE} LIKE questions")
+    staging_sql = INSERT_SQL.replace('INSERT INTO questions', f'INSERT INTO {STAGING_TABLE}')
+
+    seen = set()
+    loaded = duplicates = invalid = 0
+    without_id = []
+    for df, _ in prefetch(read_excel_chunks(path, chunk_size)):
+        rows = []
+        cleaned, invalid_ids = clean_frame(df)
+        invalid += report_invalid_ids(invalid_ids)
+        for row in cleaned:
+            if row[0] is None:
+                without_id.append(row)
+            elif row[0] in seen:
+                duplicates += 1
+            else:
+                seen.add(row[0])
+                rows.append(row)
+        if rows:
+            cursor.executemany(staging_sql, rows)
+            loaded += len(rows)
+    return loaded, duplicates, without_id, invalid
+
+def diff_staging(cursor):
+    """Compare staging with questions: {'new', 'changed', 'removed': [ids], 'unchanged': count}"""
+    cursor.execute(f"""
+        SELECT s.id FROM {STAGING_TABLE} s
+        LEFT JOIN questions q ON q.id = s.id
+        WHERE q.id IS NULL
+    """)
+    new = [row[0] for row in cursor.fetchall()]
+    cursor.execute(f"""
+        SELECT s.id FROM {STAGING_TABLE} s
+        JOIN questions q ON q.id = s.id
+        WHERE {ROW_DIFFERS}
+    """)
+    changed = [row[0] for row in cursor.fetchall()]
+    cursor.execute(f"""
+        SELECT q.id FROM questions q
+        LEFT JOIN {STAGING_TABLE} s ON s.id = q.id
+        WHERE s.id IS NULL
+    """)
+    removed = [row[0] for row in cursor.fetchall()]
+    cursor.execute(f"SELECT COUNT(*) FROM {STAGING_TABLE}")
+    unchanged = cursor.fetchone()[0] - len(new) - len(changed)
+    return {'new': new, 'changed': changed, 'unchanged': unchanged, 'removed': removed}
+
+def merge_staging(connection, cursor, path, allow_updates=False, delete_removed=False,
+                  chunk_size=IMPORT_CHUNK_SIZE):
+    """Staging-table import: load the sheet, diff it against questions, apply it set-based
+    
+    New ids are inserted with one INSERT ... SELECT; changed rows are updated
+    with one UPDATE ... JOIN (only when allow_updates, and only rows that
+    differ, so updated_at - and the embeddings /sync - moves for those alone);
+    ids missing from the sheet are deleted only with delete_removed. Everything
+    is committed as one transaction, and the applied ids are recorded in
+    question_changes under a shared import_id.
+    
+    Returns:
+        (import_id, diff) - diff as from diff_staging, plus 'duplicates' and 'invalid'
+    """
+    create_changes_table(cursor)
+    print(f"  → Loading {os.path.basename(path)} into staging table...")
+    loaded, duplicates, without_id, invalid = load_staging(cursor, path, chunk_size)
+    print(f"  ✓ Staged {loaded} rows ({duplicates} duplicate ids skipped, {len(without_id)} rows without id, {invalid} invalid ids)")
+
+    diff = diff_staging(cursor)
+    diff['duplicates'] = duplicates
+    diff['invalid'] = invalid
+    print(f"  → Diff: {len(diff['new'])} new | {len(diff['changed'])} changed | "
+          f"{diff['unchanged']} unchanged | {len(diff['removed'])} removed")
+
+    columns = ', '.join(COLUMNS)
+    try:
+        cursor.execute(f"""
+            INSERT INTO questions ({columns})
+            SELECT {', '.join('s.' + c for c in COLUMNS)} FROM {STAGING_TABLE} s
+            LEFT JOIN questions q ON q.id = s.id
+            WHERE q.id IS NULL
+        """)
+        # Rows without an id get theirs from auto-increment
+        for row in without_id:
+            cursor.execute(INSERT_SQL, row)
+            diff['new'].append(cursor.lastrowid)
+
+        applied = {'new': diff['new']}
+        if allow_updates and diff['changed']:
+            cursor.execute(f"""
+                UPDATE questions q
+                JOIN {STAGING_TABLE} s ON s.id = q.id
+                SET {', '.join(f'q.{c} = s.{c}' for c in COLUMNS[1:])}
+                WHERE {ROW_DIFFERS}
+            """)
+            applied['changed'] = diff['changed']
+        if delete_removed and diff['removed']:
+            cursor.execute(f"""
+                DELETE q FROM questions q
+                LEFT JOIN {STAGING_TABLE} s ON s.id = q.id
+                WHERE s.id IS NULL
+            """)
+            applied['removed'] = diff['removed']
+
+        import_id = datetime.now().strftime('%Y%m%d%H%M%S%f')
+        changes = [(import_id, question_id, change_type)
+                   for change_type, ids in applied.items() for question_id in ids]
+        if changes:
+            cursor.executemany(
+                "INSERT INTO question_changes (import_id, question_id, change_type) VALUES (%s, %s, %s)",
+                changes
+            )
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS {STAGING_TABLE}")
+
+    if diff['changed'] and not allow_updates:
+        print(f"  → {len(diff['changed'])} changed rows left as is (ALLOW_UPDATES is off)")
+    if diff['removed'] and not delete_removed:
+        print(f"  → {len(diff['removed'])} ids not in the sheet kept (DELETE_REMOVED is off)")
+    print(f"  ✓ Merge {import_id}: {len(changes)} changed ids recorded in 'question_changes'")
+    return import_id, diff
+
 def main():
     print("=" * 60)
     print("Loading Excel data to MariaDB - Help Center")
@@ -149,11 +631,7 @@ def main():
         # Load Excel file
         print(f"\n3. Loading Excel file: Questions.xlsx")
         
-        # Read the single sheet (no need to specify sheet_name, it will read the first/only sheet)
         print(f"\n4. Processing data...")
-        df = pd.read_excel(EXCEL_FILE)
-        
-        print(f"  → Found {len(df)} rows")
         
         total_inserted = 0
         total_updated = 0
@@ -163,14 +641,44 @@ def main():
         # Set to False (recommended) to prevent accidental overwrites
         ALLOW_UPDATES = False  # Change to False for safer inserts
         
+        # Merge mode only: delete questions whose id is no longer in the sheet
+        # Keep False unless the sheet is the full source of truth (admin-created rows are not in it)
+        DELETE_REMOVED = False
+        
         # Insert data
-        inserted, updated, errors = insert_data(cursor, df, 'All Questions', allow_updates=ALLOW_UPDATES)
+        duplicates = 0
+        if IMPORT_MODE == 'merge':
+            import_id, diff = merge_staging(
+                connection, cursor, EXCEL_FILE, allow_updates=ALLOW_UPDATES, delete_removed=DELETE_REMOVED
+            )
+            inserted = len(diff['new'])
+            updated = len(diff['changed']) if ALLOW_UPDATES else 0
+            errors = diff['invalid']
+            duplicates = diff['duplicates']
+        elif IMPORT_MODE == 'stream':
+            # Workbook is never loaded whole: memory stays flat whatever the export size
+            print(f"  → Streaming import, {IMPORT_CHUNK_SIZE} rows per chunk")
+            inserted, updated, errors, duplicates = insert_data_stream(
+                connection, cursor, EXCEL_FILE, allow_updates=ALLOW_UPDATES
+            )
+        elif IMPORT_MODE == 'bulk':
+            # Read the single sheet (no need to specify sheet_name, it will read the first/only sheet)
+            df = pd.read_excel(EXCEL_FILE)
+            print(f"  → Found {len(df)} rows")
+            print(f"  → Bulk import, {IMPORT_CHUNK_SIZE} rows per chunk")
+            inserted, updated, errors, duplicates = insert_data_bulk(
+                connection, cursor, df, allow_updates=ALLOW_UPDATES
+            )
+        else:
+            df = pd.read_excel(EXCEL_FILE)
+            print(f"  → Found {len(df)} rows")
+            inserted, updated, errors = insert_data(cursor, df, 'All Questions', allow_updates=ALLOW_UPDATES)
         
         total_inserted += inserted
         total_updated += updated
         total_errors += errors
         
-        print(f"  ✓ Inserted: {inserted} | Updated: {updated} | Errors: {errors}")
+        print(f"  ✓ Inserted: {inserted} | Updated: {updated} | Errors: {errors} | Duplicates skipped: {duplicates}")
         
         # Commit changes
         connection.commit()
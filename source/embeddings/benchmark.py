@@ -0,0 +1,741 @@
+"""
+Offline benchmark for the embeddings service.
+
+Runs embeddings_exposer in-process against local stand-ins: a deterministic
+embedding provider, a chat-completion provider with configurable latency,
+an in-memory vector store in place of Elasticsearch and the questions of
+source/data/questions.xlsx in place of MySQL. No network, no API key.
+
+Phases: /build_index (full embed + index), /sync after editing a share of
+the rows, then a replayed /ask + /ask/stream query mix through the ASGI
+app. Reports throughput, p50/p95/p99 latency and memory.
+
+    cd source/embeddings
+    python benchmark.py
+    python benchmark.py --queries 2000 --concurrency 32 --llm-latency 0.3
+    python benchmark.py --save bench.json
+    python benchmark.py --baseline bench.json --tolerance 0.2   # exit 1 on regression
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import importlib
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timezone
+from unittest import mock
+
+import httpx
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_FILE = os.path.join(SCRIPT_DIR, "..", "data", "questions.xlsx")
+
+CORPUS_UPDATED_AT = datetime(2024, 1, 1)
+
+
+# ====================================================================
+# CORPUS + QUERY MIX
+# ====================================================================
+
+def text_or_none(value):
+    return str(value) if pd.notna(value) else None
+
+
+def load_corpus(path: str = DATA_FILE) -> list:
+    """questions.xlsx as the rows the service reads from the questions table."""
+    df = pd.read_excel(path)
+    return [
+        {
+            "id": int(row["id"]),
+            "title": text_or_none(row["Title"]),
+            "content": text_or_none(row["Content"]),
+            "post_type": text_or_none(row["Post Type"]),
+            "langues": text_or_none(row["Langues"]),
+            "ecoles": text_or_none(row["Écoles"]),
+            "status": text_or_none(row["Status"]),
+            "updated_at": CORPUS_UPDATED_AT
+        }
+        for _, row in df.iterrows()
+        if pd.notna(row["id"])
+    ]
+
+
+OFF_TOPIC = [
+    "Quel temps fera-t-il demain ?",
+    "Where can I park my bike?",
+    "Est-ce que la cafétéria est ouverte le samedi ?",
+    "How do I become a teaching assistant?",
+    "Je n'arrive pas à me connecter",
+]
+
+
+def paraphrase(title: str, rng: random.Random) -> str:
+    """A near-duplicate of a title: lower-cased, one word dropped, maybe reordered."""
+    words = title.lower().rstrip(" ?").split()
+    if len(words) > 3:
+        words.pop(rng.randrange(len(words)))
+    if len(words) > 4 and rng.random() < 0.3:
+        i = rng.randrange(len(words) - 1)
+        words[i], words[i + 1] = words[i + 1], words[i]
+    return " ".join(words) + " ?"
+
+
+def build_query_mix(rows: list, count: int, seed: int = 7, hot_set: int = 50, stream_share: float = 0.2) -> list:
+    """
+    Help-center traffic: most questions are repeats of a few popular ones
+    (Zipf over hot_set titles), the rest are paraphrases, filtered queries
+    and a few off-topic questions. Returns [(endpoint, payload)].
+    """
+    rng = random.Random(seed)
+    published = [row for row in rows if row["status"] == "publish" and row["title"]]
+    hot = rng.sample(published, min(hot_set, len(published)))
+    weights = [1 / rank for rank in range(1, len(hot) + 1)]
+
+    mix = []
+    for _ in range(count):
+        draw = rng.random()
+        payload = {"top_k": 5, "use_llm": True}
+        if draw < 0.6:
+            payload["message"] = rng.choices(hot, weights)[0]["title"]
+        elif draw < 0.85:
+            payload["message"] = paraphrase(rng.choice(published)["title"], rng)
+        elif draw < 0.95:
+            row = rng.choice(published)
+            payload["message"] = paraphrase(row["title"], rng)
+            payload["language"] = "fr" if row["langues"] == "Français" else "en"
+            schools = (row["ecoles"] or "").split()
+            if schools:
+                payload["school"] = rng.choice(schools)
+        else:
+            payload["message"] = rng.choice(OFF_TOPIC)
+
+        endpoint = "/ask/stream" if rng.random() < stream_share else "/ask"
+        mix.append((endpoint, payload))
+    return mix
+
+
+# ====================================================================
+# STAND-INS: OPENAI
+# ====================================================================
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+class FakeEmbedder:
+    """
+    Deterministic embeddings by feature hashing: every word adds +-1 to a
+    hashed dimension, then the vector is L2-normalized. Texts sharing words
+    land close together, so retrieval behaves like a (crude) real model.
+    """
+
+    def __init__(self, dims: int, latency: float = 0.0):
+        self.dims = dims
+        self.latency = latency
+        self.calls = 0
+
+    def vector(self, text: str) -> list:
+        vector = np.zeros(self.dims, dtype=np.float32)
+        for token in TOKEN_RE.findall(text.lower()):
+            digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dims
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        if not norm:
+            vector[0], norm = 1.0, 1.0
+        return (vector / norm).tolist()
+
+    def response(self, inputs):
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        self.calls += 1
+        return types.SimpleNamespace(
+            data=[types.SimpleNamespace(index=i, embedding=self.vector(text)) for i, text in enumerate(inputs)],
+            usage=types.SimpleNamespace(prompt_tokens=sum(len(t.split()) for t in inputs), completion_tokens=None)
+        )
+
+    def create(self, model, input):
+        time.sleep(self.latency)
+        return self.response(input)
+
+    async def acreate(self, model, input):
+        await asyncio.sleep(self.latency)
+        return self.response(input)
+
+
+class FakeChat:
+    """Chat completions answering in the service's JSON schema, citing the excerpts it was given."""
+
+    def __init__(self, latency: float = 0.0, stream_chunks: int = 20):
+        self.latency = latency
+        self.stream_chunks = stream_chunks
+        self.calls = 0
+
+    def answer(self, messages) -> str:
+        user = json.loads(messages[-1]["content"])
+        excerpts = user["excerpts"][:3]
+        return json.dumps({
+            "language": "fr",
+            "answered": True,
+            "answer_html": "".join(f"<p>{e['title']} [{e['title']}]</p>" for e in excerpts),
+            "reason_if_unanswered": None,
+            "used_source_ids": [e["id"] for e in excerpts],
+            "citations": [{"id": e["id"], "title": e["title"], "url": None} for e in excerpts],
+            "meta": {"query_echo": user["user_question"], "notes": "benchmark"},
+            "redirect": {"needed": False, "label": None, "url": None}
+        }, ensure_ascii=False)
+
+    async def acreate(self, model, messages, stream=False, **kwargs):
+        self.calls += 1
+        content = self.answer(messages)
+        usage = types.SimpleNamespace(prompt_tokens=len(messages[-1]["content"]) // 4, completion_tokens=len(content) // 4)
+        if not stream:
+            await asyncio.sleep(self.latency)
+            return types.SimpleNamespace(
+                choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=content))],
+                usage=usage
+            )
+        return self.stream(content, usage)
+
+    async def stream(self, content: str, usage):
+        step = max(len(content) // self.stream_chunks, 1)
+        for i in range(0, len(content), step):
+            await asyncio.sleep(self.latency / self.stream_chunks)
+            delta = types.SimpleNamespace(content=content[i:i + step])
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)], usage=None)
+        yield types.SimpleNamespace(choices=[], usage=usage)
+
+
+class FakeAsyncOpenAI:
+    def __init__(self, embedder: FakeEmbedder, chat: FakeChat):
+        self.embeddings = types.SimpleNamespace(create=embedder.acreate)
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=chat.acreate))
+
+    async def close(self):
+        pass
+
+
+# ====================================================================
+# STAND-INS: ELASTICSEARCH (in-process vector store)
+# ====================================================================
+
+class InMemoryIndex:
+    """
+    The documents of one index plus a normalized float32 matrix of their
+    embeddings, rebuilt lazily after writes. Serves the subset of the
+    search API the service uses: knn / exact script_score vector queries
+    with term pre-filters, PIT + search_after walks and the updated_at max.
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self._ids = []
+        self._matrix = None
+
+    def write(self, action) -> dict:
+        doc_id = str(action["_id"])  # "<id>" or, for passage documents, "<id>_<passage>"
+        self._matrix = None
+        if action["_op_type"] == "delete":
+            if self.docs.pop(doc_id, None) is None:
+                return {"_id": doc_id, "status": 404}
+            return {"_id": doc_id, "status": 200}
+        self.docs[doc_id] = action["_source"]
+        return {"_id": doc_id, "status": 201}
+
+    def delete_questions(self, ids) -> int:
+        """_delete_by_query on a terms query over the id field."""
+        ids = {str(i) for i in ids}
+        doomed = [doc_id for doc_id, doc in self.docs.items() if str(doc.get("id")) in ids]
+        for doc_id in doomed:
+            del self.docs[doc_id]
+        self._matrix = None
+        return len(doomed)
+
+    def matrix(self):
+        if self._matrix is None:
+            self._ids = list(self.docs)
+            matrix = np.array([self.docs[i]["embedding"] for i in self._ids], dtype=np.float32).reshape(len(self._ids), -1)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            self._matrix = matrix / np.where(norms == 0, 1, norms)
+        return self._ids, self._matrix
+
+    @staticmethod
+    def matches(doc: dict, filters: list) -> bool:
+        for clause in filters:
+            (field, value), = clause["term"].items()
+            stored = doc.get(field)
+            if stored != value and not (isinstance(stored, list) and value in stored):
+                return False
+        return True
+
+    def vector_search(self, size: int, knn: dict = None, query: dict = None, _source=None, **_):
+        if knn:
+            vector, k = knn["query_vector"], knn["k"]
+            filters = knn.get("filter", {}).get("bool", {}).get("filter", [])
+        else:
+            script = query["script_score"]
+            vector, k = script["script"]["params"]["query_vector"], size
+            filters = script["query"].get("bool", {}).get("filter", [])
+
+        ids, matrix = self.matrix()
+        if not ids:
+            return {"hits": {"hits": []}}
+        vector = np.asarray(vector, dtype=np.float32)
+        scores = (matrix @ (vector / (np.linalg.norm(vector) or 1)) + 1) / 2
+        if filters:
+            mask = np.array([self.matches(self.docs[i], filters) for i in ids])
+            scores = np.where(mask, scores, -np.inf)
+
+        k = min(k, size, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        hits = []
+        for i in top:
+            if scores[i] == -np.inf:
+                break
+            doc = self.docs[ids[i]]
+            source = {f: doc.get(f) for f in _source} if isinstance(_source, list) else ({} if _source is False else doc)
+            hits.append({"_id": str(ids[i]), "_score": float(scores[i]), "_source": source})
+        return {"hits": {"hits": hits}}
+
+
+class FakeIndices:
+    def __init__(self, store: dict):
+        self.store = store
+        self.settings = {}
+
+    def exists(self, index):
+        return index in self.store
+
+    def create(self, index, mappings=None, settings=None):
+        self.store[index] = InMemoryIndex()
+
+    def put_mapping(self, index, properties):
+        pass
+
+    def get_settings(self, index, name=None):
+        return {index: {"settings": {"index": {"refresh_interval": self.settings.get(index)}}}}
+
+    def put_settings(self, index, settings):
+        self.settings[index] = settings["index"].get("refresh_interval")
+
+    def refresh(self, index):
+        pass
+
+
+class FakeElasticsearch:
+    """Synchronous client facade (build/sync jobs) over the in-memory indices."""
+
+    PAGE_SORT = "_shard_doc"
+
+    def __init__(self):
+        self.store = {}
+        self.indices = FakeIndices(self.store)
+
+    def index(self, name) -> InMemoryIndex:
+        return self.store.setdefault(name, InMemoryIndex())
+
+    def open_point_in_time(self, index, keep_alive):
+        return {"id": index}
+
+    def close_point_in_time(self, id):
+        pass
+
+    def search(self, index=None, pit=None, size=10, aggs=None, search_after=None, **params):
+        target = self.index(pit["id"] if pit else index)
+        if aggs:
+            dates = [d["updated_at"] for d in target.docs.values() if d.get("updated_at")]
+            latest = max(dates).replace(tzinfo=timezone.utc).timestamp() * 1000 if dates else None
+            return {"aggregations": {"hwm": {"value": latest}}}
+        if pit:
+            ids = sorted(i for i in target.docs if search_after is None or i > search_after[0])[:size]
+            return {"hits": {"hits": [
+                {"_id": i, "_source": {f: target.docs[i].get(f) for f in ("id", "content_hash")}, "sort": [i]}
+                for i in ids
+            ]}}
+        return target.vector_search(size=size, **params)
+
+    def delete_by_query(self, index, query, **_):
+        return {"deleted": self.index(index).delete_questions(query["terms"]["id"]), "failures": []}
+
+    def bulk_index(self, es, actions, chunk_size=None, job=None):
+        """Drop-in for embeddings_exposer.bulk_index, writing straight to the store."""
+        succeeded = 0
+        for action in actions:
+            self.index(action["_index"]).write(action)
+            if job:
+                job.check_cancelled()
+                job.advance(indexed=1)
+            succeeded += 1
+        return succeeded, []
+
+
+class FakeAsyncElasticsearch:
+    def __init__(self, es: FakeElasticsearch):
+        self.es = es
+
+    async def search(self, **params):
+        return self.es.search(**params)
+
+    async def close(self):
+        pass
+
+
+# ====================================================================
+# STAND-IN: MYSQL
+# ====================================================================
+
+class FakeCursor:
+    def __init__(self, rows: list, dictionary: bool):
+        self.rows = rows
+        self.dictionary = dictionary
+        self.result = []
+
+    def execute(self, sql, params=None):
+        published = [row for row in self.rows if row["status"] == "publish"]
+        if sql.startswith("SET SESSION"):
+            self.result = []
+        elif "COUNT(*)" in sql:
+            self.result = [(len(published),)]
+        elif "WHERE id IN" in sql:
+            wanted = set(params)
+            self.result = [dict(row) for row in self.rows if row["id"] in wanted]
+        elif "SELECT id, updated_at" in sql:
+            self.result = [(row["id"], row["updated_at"]) for row in published]
+        else:
+            self.result = [dict(row) for row in published]
+
+    def fetchall(self):
+        result, self.result = self.result, []
+        return result
+
+    def fetchone(self):
+        return self.fetchall()[0]
+
+    def fetchmany(self, size=1):
+        result, self.result = self.result[:size], self.result[size:]
+        return result
+
+    def close(self):
+        pass
+
+
+class FakeMySQL:
+    def __init__(self, rows: list):
+        self.rows = rows
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield types.SimpleNamespace(
+            cursor=lambda dictionary=False, **_: FakeCursor(self.rows, dictionary),
+            unread_result=False,
+            consume_results=lambda: None
+        )
+
+    def edit(self, share: float, seed: int = 11) -> int:
+        """Edit the content of a share of the rows, as the admin backend would."""
+        rng = random.Random(seed)
+        edited = rng.sample(self.rows, int(len(self.rows) * share))
+        now = datetime.now()
+        for row in edited:
+            row["content"] = f"{row['content'] or ''} (mise à jour {now:%H:%M:%S})"
+            row["updated_at"] = now
+        return len(edited)
+
+
+# ====================================================================
+# MEASUREMENTS
+# ====================================================================
+
+def memory_mb() -> dict:
+    """Current and peak resident set size of this process, when the platform exposes them."""
+    usage = {}
+    try:
+        with open("/proc/self/statm") as f:
+            usage["rss_mb"] = round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20, 1)
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        usage["peak_rss_mb"] = round(peak / (2 ** 20 if sys.platform == "darwin" else 2 ** 10), 1)
+    return usage
+
+
+def latency_summary(latencies: list, percentile) -> dict:
+    ms = [s * 1000 for s in latencies]
+    return {
+        "p50_ms": round(percentile(ms, 50), 2) if ms else None,
+        "p95_ms": round(percentile(ms, 95), 2) if ms else None,
+        "p99_ms": round(percentile(ms, 99), 2) if ms else None,
+        "max_ms": round(max(ms), 2) if ms else None
+    }
+
+
+def stage_means(before: dict) -> dict:
+    """Mean /ask stage latency (ms) from the service's own rag_stage_seconds histogram."""
+    from metrics import STAGES
+    from prometheus_client import REGISTRY
+
+    means = {}
+    for stage, (sum_before, count_before) in before.items():
+        total = REGISTRY.get_sample_value("rag_stage_seconds_sum", {"stage": stage}) - sum_before
+        count = REGISTRY.get_sample_value("rag_stage_seconds_count", {"stage": stage}) - count_before
+        means[stage] = round(total / count * 1000, 3) if count else None
+    return {stage: means[stage] for stage in STAGES}
+
+
+def stage_snapshot() -> dict:
+    from metrics import STAGES
+    from prometheus_client import REGISTRY
+
+    return {
+        stage: (
+            REGISTRY.get_sample_value("rag_stage_seconds_sum", {"stage": stage}) or 0.0,
+            REGISTRY.get_sample_value("rag_stage_seconds_count", {"stage": stage}) or 0.0
+        )
+        for stage in STAGES
+    }
+
+
+# ====================================================================
+# PHASES
+# ====================================================================
+
+def bench_build(ex, jobs) -> dict:
+    job = jobs.Job("build_index", {"mode": "inplace"})
+    started = time.perf_counter()
+    result = ex.run_build_index(job, "inplace")
+    elapsed = time.perf_counter() - started
+    return {
+        "docs": result["indexed"],
+        "seconds": round(elapsed, 3),
+        "docs_per_s": round(result["indexed"] / elapsed, 1),
+        "embedding_batches": result["throughput"]["batches"],
+        **memory_mb()
+    }
+
+
+def bench_sync(ex, jobs, db: FakeMySQL, share: float) -> dict:
+    edited = db.edit(share)
+    job = jobs.Job("sync", {"full": False})
+    started = time.perf_counter()
+    result = ex.run_sync(job, False)
+    elapsed = time.perf_counter() - started
+    return {
+        "edited": edited,
+        "checked": result["checked"],
+        "updated": result["updated"],
+        "seconds": round(elapsed, 3),
+        "rows_per_s": round(result["checked"] / elapsed, 1) if elapsed else None,
+        **memory_mb()
+    }
+
+
+async def replay(app, mix: list, concurrency: int):
+    """Send the query mix through the ASGI app with `concurrency` clients. Returns (latencies by endpoint, errors, seconds)."""
+    queue = asyncio.Queue()
+    for item in mix:
+        queue.put_nowait(item)
+    latencies = {"/ask": [], "/ask/stream": []}
+    errors = []
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        async def worker():
+            while not queue.empty():
+                endpoint, payload = queue.get_nowait()
+                started = time.perf_counter()
+                response = await client.post(endpoint, json=payload)
+                elapsed = time.perf_counter() - started
+                if response.status_code != 200:
+                    errors.append({"endpoint": endpoint, "status": response.status_code})
+                    continue
+                latencies[endpoint].append(elapsed)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return latencies, errors, time.perf_counter() - started
+
+
+def bench_ask(ex, mix: list, concurrency: int, warmup: int) -> dict:
+    if warmup:
+        asyncio.run(replay(ex.app, mix[:warmup], concurrency))
+    before = stage_snapshot()
+    latencies, errors, elapsed = asyncio.run(replay(ex.app, mix[warmup:], concurrency))
+    done = sum(len(values) for values in latencies.values())
+
+    return {
+        "requests": done,
+        "errors": len(errors),
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "qps": round(done / elapsed, 1) if elapsed else None,
+        **latency_summary(latencies["/ask"] + latencies["/ask/stream"], ex.percentile),
+        "by_endpoint": {
+            endpoint: {"requests": len(values), **latency_summary(values, ex.percentile)}
+            for endpoint, values in latencies.items()
+        },
+        "stage_mean_ms": stage_means(before),
+        "cache_hit_rates": {
+            "query_embeddings": ex.QUERY_EMBEDDING_CACHE.stats()["hit_rate"],
+            "answers": ex.ANSWER_CACHE.stats()["hit_rate"]
+        },
+        **memory_mb()
+    }
+
+
+# ====================================================================
+# REPORT + REGRESSION CHECK
+# ====================================================================
+
+# (phase, metric, higher_is_better)
+TRACKED = [
+    ("build_index", "docs_per_s", True),
+    ("sync", "rows_per_s", True),
+    ("ask", "qps", True),
+    ("ask", "p95_ms", False),
+    ("ask", "p99_ms", False),
+    ("ask", "peak_rss_mb", False),
+]
+
+
+def regressions(report: dict, baseline: dict, tolerance: float) -> list:
+    found = []
+    for phase, metric, higher_is_better in TRACKED:
+        old = baseline.get(phase, {}).get(metric)
+        new = report.get(phase, {}).get(metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if (change < -tolerance) if higher_is_better else (change > tolerance):
+            found.append(f"{phase}.{metric}: {old} -> {new} ({change:+.1%})")
+    return found
+
+
+def print_report(report: dict):
+    print("=" * 60)
+    print("EMBEDDINGS SERVICE BENCHMARK (offline)")
+    print("=" * 60)
+    for phase in ("build_index", "sync", "ask"):
+        print(f"\n[{phase}]")
+        for key, value in report[phase].items():
+            if isinstance(value, dict):
+                print(f"  {key}:")
+                for sub_key, sub_value in value.items():
+                    print(f"    {sub_key:<20} {sub_value}")
+            else:
+                print(f"  {key:<22} {value}")
+    print("\nsettings:", json.dumps(report["settings"]))
+
+
+# ====================================================================
+# MAIN
+# ====================================================================
+
+def load_service(cache_dir: str, log_level: str, backend: str, dtype: str, search_mode: str, granularity: str):
+    """Import embeddings_exposer with a throw-away embedding cache / local index and quiet logs."""
+    os.environ["EMBED_CACHE_PATH"] = os.path.join(cache_dir, "embeddings.sqlite3")
+    os.environ["VECTOR_BACKEND"] = backend
+    os.environ["LOCAL_INDEX_PATH"] = os.path.join(cache_dir, "vector_index")
+    os.environ["LOCAL_INDEX_DTYPE"] = dtype
+    os.environ["ASK_SEARCH_MODE"] = search_mode
+    os.environ["INDEX_GRANULARITY"] = granularity
+    os.environ["LOG_LEVEL"] = log_level
+    os.environ.setdefault("ES_INDEX", "faq_bench")
+    sys.path.insert(0, SCRIPT_DIR)
+    return importlib.import_module("embeddings_exposer"), importlib.import_module("jobs")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of /build_index, /sync and /ask")
+    parser.add_argument("--queries", type=int, default=500, help="/ask requests replayed")
+    parser.add_argument("--warmup", type=int, default=50, help="requests sent before measuring")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--stream-share", type=float, default=0.2, help="share of requests sent to /ask/stream")
+    parser.add_argument("--embed-latency", type=float, default=0.02, help="seconds per embeddings call")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds per chat completion")
+    parser.add_argument("--sync-share", type=float, default=0.05, help="share of rows edited before /sync")
+    parser.add_argument("--backend", choices=["elasticsearch", "local"], default="elasticsearch",
+                        help="elasticsearch = in-memory ES stand-in, local = the real mmap NumPy index")
+    parser.add_argument("--local-dtype", choices=["float32", "int8"], default="float32")
+    parser.add_argument("--search-mode", choices=["knn", "exact", "hybrid"], default="knn",
+                        help="hybrid needs --backend local (the ES stand-in has no BM25)")
+    parser.add_argument("--granularity", choices=["document", "passage"], default="document",
+                        help="index one vector per question or one per passage")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--data", default=DATA_FILE)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--save", help="write the JSON report here")
+    parser.add_argument("--baseline", help="JSON report to compare against; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative change vs. baseline")
+    args = parser.parse_args()
+    if args.search_mode == "hybrid" and args.backend != "local":
+        parser.error("--search-mode hybrid requires --backend local")
+
+    cache_dir = tempfile.mkdtemp(prefix="faq-bench-")
+    ex, jobs = load_service(cache_dir, args.log_level, args.backend, args.local_dtype, args.search_mode, args.granularity)
+
+    rows = load_corpus(args.data)
+    mix = build_query_mix(rows, args.queries + args.warmup, seed=args.seed, stream_share=args.stream_share)
+
+    dims = ex.INDEX_MAPPINGS["properties"]["embedding"]["dims"]
+    embedder = FakeEmbedder(dims, args.embed_latency)
+    chat = FakeChat(args.llm_latency)
+    es = FakeElasticsearch()
+    db = FakeMySQL(rows)
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.object(ex, "get_es", lambda: es))
+        stack.enter_context(mock.patch.object(ex, "bulk_index", es.bulk_index))
+        stack.enter_context(mock.patch.object(ex, "mysql_connection", db.connection))
+        stack.enter_context(mock.patch.object(ex.openai, "embeddings", types.SimpleNamespace(create=embedder.create)))
+        stack.enter_context(mock.patch.object(ex, "_async_openai_client", FakeAsyncOpenAI(embedder, chat)))
+        stack.enter_context(mock.patch.object(ex, "_async_es_client", FakeAsyncElasticsearch(es)))
+        try:
+            report = {
+                "build_index": bench_build(ex, jobs),
+                "sync": bench_sync(ex, jobs, db, args.sync_share),
+                "ask": bench_ask(ex, mix, args.concurrency, args.warmup),
+            }
+        finally:
+            ex.EMBEDDING_CACHE.close()
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    report["settings"] = {
+        key: getattr(args, key)
+        for key in ("backend", "local_dtype", "search_mode", "granularity", "queries", "warmup", "concurrency", "stream_share", "embed_latency", "llm_latency", "sync_share", "seed")
+    }
+    report["settings"]["corpus"] = len(rows)
+    print_report(report)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n✓ Report saved to {args.save}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(report, json.load(f), args.tolerance)
+        if found:
+            print(f"\n✗ Regressions beyond {args.tolerance:.0%}:")
+            for line in found:
+                print(f"  - {line}")
+            sys.exit(1)
+        print(f"\n✓ No regression beyond {args.tolerance:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
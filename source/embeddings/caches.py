@@ -0,0 +1,241 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# ====================================================================
+# ON-DISK EMBEDDING CACHE (documents)
+# ====================================================================
+
+class EmbeddingDiskCache:
+    """
+    Persistent embedding cache backed by SQLite.
+
+    Entries are keyed by model name + sha256 of the exact embedded text, so a
+    row is only re-embedded when its text (or the model) changes. Once the
+    cache holds more than max_entries, the least recently used entries are
+    evicted.
+    """
+
+    SQL_CHUNK = 500  # stay well below SQLite's bound-parameter limit
+
+    def __init__(self, path: str, max_entries: int = 100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, texts: list) -> list:
+        """Return one embedding per text, or None where the cache has no entry."""
+        keys = [self.make_key(model, text) for text in texts]
+        found = {}
+
+        with self._lock:
+            for i in range(0, len(keys), self.SQL_CHUNK):
+                chunk = keys[i:i + self.SQL_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                for key, blob in self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ):
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+                self._conn.commit()
+
+            results = [found.get(key) for key in keys]
+            hits = sum(1 for r in results if r is not None)
+            self.hits += hits
+            self.misses += len(results) - hits
+
+        return results
+
+    def put_many(self, model: str, texts: list, embeddings: list):
+        now = time.time()
+        rows = [
+            (self.make_key(model, text), model, array("f", embedding).tobytes(), now)
+            for text, embedding in zip(texts, embeddings)
+        ]
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, vector, last_used) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                (overflow,)
+            )
+            self.evictions += overflow
+
+    def stats(self) -> dict:
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# ====================================================================
+# IN-PROCESS LRU / TTL CACHE (queries)
+# ====================================================================
+
+def normalize_query(text: str) -> str:
+    """Case-fold, strip accents and collapse whitespace: 'Stage  à  l'étranger' == 'stage a l'etranger'."""
+    decomposed = unicodedata.normalize("NFKD", text)
+    without_accents = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(without_accents.casefold().split())
+
+
+class TTLCache:
+    """
+    Thread-safe in-process LRU cache. Entries older than ttl seconds are
+    treated as misses; beyond max_entries the least recently used is dropped.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard_where(self, predicate) -> int:
+        """Drop every entry whose key satisfies predicate. Returns how many were dropped."""
+        with self._lock:
+            doomed = [key for key in self._entries if predicate(key)]
+            for key in doomed:
+                del self._entries[key]
+        return len(doomed)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "expirations": self.expirations,
+            "evictions": self.evictions
+        }
+
+
+# ====================================================================
+# ANSWER CACHE (full /ask responses)
+# ====================================================================
+
+class AnswerCache(TTLCache):
+    """
+    Cache of synthesized /ask answers.
+
+    The key is the normalized question plus the sorted (id, content hash)
+    pairs of the matched documents: the same question retrieving the same,
+    unchanged documents gets the same answer. An edited document changes its
+    hash, so stale answers can never be served; invalidate_ids() additionally
+    frees entries citing documents touched by /sync or /build_index.
+    """
+
+    @staticmethod
+    def make_key(query: str, matches: list):
+        sources = sorted(
+            (str(m["id"]), content_hash(f"{m['question']} {m['answer']}"))
+            for m in matches
+        )
+        return normalize_query(query), tuple(sources)
+
+    def invalidate_ids(self, ids) -> int:
+        ids = {str(i) for i in ids}
+        if not ids:
+            return 0
+        return self.discard_where(lambda key: any(doc_id in ids for doc_id, _ in key[1]))
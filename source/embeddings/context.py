@@ -0,0 +1,231 @@
+import math
+import re
+from html.parser import HTMLParser
+
+from vector_store import tokenize
+
+try:
+    import tiktoken
+except ImportError:  # token counts fall back to the ~4 characters/token rule
+    tiktoken = None
+
+
+# ====================================================================
+# LLM CONTEXT BUDGET (excerpts sent with each /ask)
+# ====================================================================
+
+BLOCK_TAGS = {"p", "br", "li", "ul", "ol", "div", "h1", "h2", "h3", "h4", "h5", "h6", "tr", "table", "blockquote"}
+SENTENCE_END = re.compile(r"(?<=[.!?;:])\s+")
+
+_encodings = {}
+
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    if not text:
+        return 0
+    if tiktoken is None:
+        return math.ceil(len(text) / 4)
+    encoding = _encodings.get(model)
+    if encoding is None:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("o200k_base")
+        _encodings[model] = encoding
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        self.parts.append(data)
+
+
+def strip_html(content: str) -> list:
+    """Plain-text blocks (paragraphs, list items) of an answer that may mix text and HTML."""
+    extractor = _TextExtractor()
+    extractor.feed(content or "")
+    extractor.close()
+    text = "".join(extractor.parts).replace("\xa0", " ")
+    return [" ".join(line.split()) for line in text.split("\n") if line.strip()]
+
+
+def cut_words(sentence: str, tokens: int, max_tokens: int, model: str) -> list:
+    """One very long sentence cut on words into pieces of ~max_tokens. Returns [(text, tokens)]."""
+    words = sentence.split()
+    step = max(len(words) * max_tokens // tokens, 1)
+    pieces = [" ".join(words[i:i + step]) for i in range(0, len(words), step)]
+    return [(piece, count_tokens(piece, model)) for piece in pieces]
+
+
+def split_passages(blocks: list, passage_tokens: int, model: str) -> list:
+    """Pack consecutive sentences into passages of at most ~passage_tokens. Returns [(text, tokens)]."""
+    passages = []
+    current, current_tokens = [], 0
+
+    def flush():
+        nonlocal current, current_tokens
+        if current:
+            passages.append((" ".join(current), current_tokens))
+        current, current_tokens = [], 0
+
+    for block in blocks:
+        for sentence in SENTENCE_END.split(block):
+            tokens = count_tokens(sentence, model)
+            if tokens > passage_tokens:
+                # One very long sentence: cut it on words
+                flush()
+                passages.extend(cut_words(sentence, tokens, passage_tokens, model))
+                continue
+            if current and current_tokens + tokens > passage_tokens:
+                flush()
+            current.append(sentence)
+            current_tokens += tokens
+        # Keep list items / paragraphs from merging into the next block's passage
+        if current_tokens >= passage_tokens // 2:
+            flush()
+    flush()
+    return passages
+
+
+def split_overlapping(content: str, passage_tokens: int, overlap_tokens: int, model: str = "gpt-4o-mini") -> list:
+    """
+    Plain-text passages of an answer for passage-level indexing: sentences
+    packed into windows of at most ~passage_tokens, each window starting
+    with the last ~overlap_tokens of sentences of the previous one so a
+    statement cut by a boundary is whole in at least one passage.
+    Returns [(text, overlap)], overlap being the number of leading
+    characters repeated from the previous passage.
+    """
+    units = []
+    for block in strip_html(content):
+        for sentence in SENTENCE_END.split(block):
+            tokens = count_tokens(sentence, model)
+            if tokens > passage_tokens:
+                units.extend(cut_words(sentence, tokens, passage_tokens, model))
+            else:
+                units.append((sentence, tokens))
+
+    passages = []
+    start = carried = 0
+    while start < len(units):
+        end, tokens = start, 0
+        # Always take at least one sentence past the carried-over ones
+        while end < len(units) and (end <= start + carried or tokens + units[end][1] <= passage_tokens):
+            tokens += units[end][1]
+            end += 1
+        text = " ".join(text for text, _ in units[start:end])
+        overlap = len(" ".join(text for text, _ in units[start:start + carried])) + 1 if carried else 0
+        passages.append((text, overlap))
+        if end == len(units):
+            break
+        # Step back over the trailing sentences worth at most overlap_tokens
+        back, overlap_used = end, 0
+        while back - 1 > start and overlap_used + units[back - 1][1] <= overlap_tokens:
+            back -= 1
+            overlap_used += units[back][1]
+        carried = end - back
+        start = back
+    return passages
+
+
+def build_context(query: str, matches: list, budget: int, passage_tokens: int = 120,
+                  max_passages: int = 3, model: str = "gpt-4o-mini"):
+    """
+    LLM excerpts for the matches within `budget` tokens of content.
+
+    Answers are stripped of HTML and cut into passages; passages are ranked
+    by lexical overlap with the question (idf-weighted over the candidate
+    passages, the opening passage of an article slightly favoured). Every
+    match first gets its best passage, in rank order, then the remaining
+    budget goes to the best passages overall, at most max_passages per
+    match. Kept passages are rejoined in article order, "…" marking cuts.
+    budget <= 0 sends the answers untouched.
+
+    Returns (excerpts, stats).
+    """
+    if budget <= 0:
+        excerpts = [{"id": m["id"], "title": m["question"], "url": None, "content": m["answer"], "language": "fr"} for m in matches]
+        tokens = sum(count_tokens(m["answer"], model) for m in matches)
+        return excerpts, {"budget": None, "original_tokens": tokens, "context_tokens": tokens}
+
+    split = [split_passages(strip_html(m["answer"]), passage_tokens, model) for m in matches]
+
+    query_terms = set(tokenize(query))
+    passage_terms = [[set(tokenize(text)) for text, _ in passages] for passages in split]
+    document_frequency = {}
+    for terms_of_match in passage_terms:
+        for terms in terms_of_match:
+            for term in terms & query_terms:
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+    total = sum(len(p) for p in split) or 1
+
+    candidates = []  # (score, match rank, position, tokens)
+    for rank, terms_of_match in enumerate(passage_terms):
+        for position, terms in enumerate(terms_of_match):
+            score = sum(math.log(1 + total / document_frequency[t]) for t in terms & query_terms)
+            if position == 0:
+                score += 0.5
+            candidates.append((score, rank, position, split[rank][position][1]))
+
+    selected = [set() for _ in matches]
+    used = 0
+
+    def take(rank, position, tokens):
+        nonlocal used
+        if used + tokens > budget or len(selected[rank]) >= max_passages:
+            return False
+        selected[rank].add(position)
+        used += tokens
+        return True
+
+    best = {}
+    for candidate in sorted(candidates, key=lambda c: (-c[0], c[1], c[2])):
+        best.setdefault(candidate[1], candidate)
+    for rank in range(len(matches)):
+        if rank in best:
+            take(*best[rank][1:])
+    for _, rank, position, tokens in sorted(candidates, key=lambda c: (-c[0], c[1], c[2])):
+        if position not in selected[rank]:
+            take(rank, position, tokens)
+
+    excerpts = []
+    for rank, match in enumerate(matches):
+        if not selected[rank]:
+            continue
+        parts = []
+        previous = -1
+        for position in sorted(selected[rank]):
+            if position != previous + 1:
+                parts.append("…")
+            parts.append(split[rank][position][0])
+            previous = position
+        if previous != len(split[rank]) - 1:
+            parts.append("…")
+        excerpts.append({
+            "id": match["id"],
+            "title": match["question"],
+            "url": None,
+            "content": " ".join(parts),
+            "language": "fr"  # Adapt if your data includes 'langues'
+        })
+
+    return excerpts, {
+        "budget": budget,
+        "original_tokens": sum(count_tokens(m["answer"], model) for m in matches),
+        "context_tokens": used,
+        "passages_kept": sum(len(s) for s in selected),
+        "passages_total": sum(len(p) for p in split),
+        "matches_dropped": sum(1 for s in selected if not s)
+    }
@@ -1,12 +1,31 @@
-from fastapi import FastAPI
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from typing import Annotated, List, Literal, Optional
 import mysql.connector
-from elasticsearch import Elasticsearch
+import mysql.connector.pooling
+from elasticsearch import AsyncElasticsearch, Elasticsearch, helpers
 import openai
 import os
+import asyncio
+import copy
 import json
+import queue
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
+from caches import AnswerCache, EmbeddingDiskCache, TTLCache, content_hash, normalize_query
+from context import build_context, split_overlapping
+from jobs import JobConflict, JobRunner
+from logs import RequestLogMiddleware, setup_logging, verbose
+from metrics import record_context, record_usage, register_caches, render_latest, stage_timer
+from vector_store import ElasticsearchStore, LocalVectorStore, collapse_passages, term_filters, write_local_index
 
 # ====================================================================
 # CONFIG
@@ -20,6 +39,121 @@ openai.api_key = OPENAI_API_KEY
 ES_HOST = os.getenv("ES_HOST")
 ES_PORT = os.getenv("ES_PORT")
 ES_INDEX = os.getenv("ES_INDEX")
+ES_BULK_CHUNK_SIZE = int(os.getenv("ES_BULK_CHUNK_SIZE") or 500)     # documents per _bulk request
+ES_BULK_MAX_RETRIES = int(os.getenv("ES_BULK_MAX_RETRIES") or 3)     # retries on 429 rejections
+ES_BULK_ERROR_SAMPLE = 50                                            # per-item errors echoed back
+ES_POOL_SIZE = int(os.getenv("ES_POOL_SIZE") or 10)                  # HTTP connections kept per ES node
+ES_REQUEST_TIMEOUT = float(os.getenv("ES_REQUEST_TIMEOUT") or 30)
+ES_REPLICAS = int(os.getenv("ES_REPLICAS") or 1)            # replicas restored after a blue/green load
+ES_KEEP_PREVIOUS = int(os.getenv("ES_KEEP_PREVIOUS") or 1)  # old generations kept for instant rollback
+
+INDEX_MAPPINGS = {
+    "properties": {
+        "id": {"type": "keyword"},
+        "question": {"type": "text"},
+        "answer": {"type": "text"},
+        "embedding": {
+            "type": "dense_vector",
+            "dims": 1536,
+            "index": True,
+            "similarity": "cosine"
+        },
+        "category": {"type": "keyword"},
+        "language": {"type": "keyword"},
+        "schools": {"type": "keyword"},
+        "content_hash": {"type": "keyword"},  # sha256 of the embedded text
+        "updated_at": {"type": "date"},       # questions.updated_at when indexed
+        "passage": {"type": "integer"},       # INDEX_GRANULARITY=passage: position in the answer
+        "overlap": {"type": "integer", "index": False}  # leading chars repeated from the previous passage
+    }
+}
+
+# What one indexed document is: "document" = a whole question (title + content),
+# "passage" = one overlapping passage of its HTML-stripped content (title prepended),
+# stored with the question's id and collapsed back to the question at query time
+INDEX_GRANULARITY = os.getenv("INDEX_GRANULARITY") or "document"
+INDEX_PASSAGE_TOKENS = int(os.getenv("INDEX_PASSAGE_TOKENS") or 200)
+INDEX_PASSAGE_OVERLAP = int(os.getenv("INDEX_PASSAGE_OVERLAP") or 40)  # tokens repeated between passages
+PASSAGE_OVERSAMPLE = int(os.getenv("PASSAGE_OVERSAMPLE") or 4)          # passages searched per requested match
+
+# /sync
+SYNC_PAGE_SIZE = int(os.getenv("SYNC_PAGE_SIZE") or 1000)       # ES hits per search_after page
+PIPELINE_CHUNK_SIZE = int(os.getenv("PIPELINE_CHUNK_SIZE") or 500)  # rows per fetch/embed/index chunk
+SYNC_WATERMARK_SLACK = timedelta(seconds=60)                     # re-check rows edited just before the mark
+
+# /ask stage budgets (seconds): embedding/search time out with 504, the LLM falls back to the best match
+ASK_EMBED_TIMEOUT = float(os.getenv("ASK_EMBED_TIMEOUT") or 5)
+ASK_SEARCH_TIMEOUT = float(os.getenv("ASK_SEARCH_TIMEOUT") or 5)
+ASK_LLM_TIMEOUT = float(os.getenv("ASK_LLM_TIMEOUT") or 30)
+DISCONNECT_POLL_INTERVAL = 0.25
+
+# Vector search: "knn" uses the HNSW graph, "exact" scores every document (recall baseline),
+# "hybrid" adds a BM25 query on question/answer and fuses both rankings
+ASK_SEARCH_MODE = os.getenv("ASK_SEARCH_MODE") or "knn"
+ES_NUM_CANDIDATES = int(os.getenv("ES_NUM_CANDIDATES") or 100)  # HNSW candidates per shard
+ES_MAX_NUM_CANDIDATES = 10000                                       # ES rejects larger knn num_candidates
+ASK_MAX_TOP_K = 100                                                 # keeps size and num_candidates within ES limits
+
+# Hybrid fusion: "rrf" (reciprocal rank fusion) or "weighted" (min-max normalized scores)
+HYBRID_FUSION = os.getenv("HYBRID_FUSION") or "rrf"
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K") or 60)
+HYBRID_WINDOW = int(os.getenv("HYBRID_WINDOW") or 20)               # candidates fetched per side
+HYBRID_BM25_WEIGHT = float(os.getenv("HYBRID_BM25_WEIGHT") or 1.0)
+HYBRID_VECTOR_WEIGHT = float(os.getenv("HYBRID_VECTOR_WEIGHT") or 1.0)
+
+# /ask retrieval backend: "elasticsearch", or "local" for an exact search over a
+# memory-mapped NumPy matrix written by /build_index and /sync (no ES round trip)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND") or "elasticsearch"
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "vector_index")
+LOCAL_INDEX_DTYPE = os.getenv("LOCAL_INDEX_DTYPE") or "float32"  # or "int8": 4x smaller, slightly less precise
+LOCAL_INDEX_RELOAD_INTERVAL = float(os.getenv("LOCAL_INDEX_RELOAD_INTERVAL") or 1)  # seconds between checks for a new generation
+
+# LLM
+LLM_MODEL = "gpt-4o-mini"
+LLM_MAX_TOKENS = 800
+
+# Excerpts sent to the LLM: answers are stripped of HTML, cut into passages and only
+# the passages closest to the question are kept, within this many tokens (0 = send everything)
+LLM_CONTEXT_BUDGET = int(os.getenv("LLM_CONTEXT_BUDGET") or 1200)
+LLM_PASSAGE_TOKENS = int(os.getenv("LLM_PASSAGE_TOKENS") or 120)
+LLM_MAX_PASSAGES = int(os.getenv("LLM_MAX_PASSAGES") or 3)          # per match
+
+# Embeddings
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE") or 100)          # texts per embeddings.create call
+EMBED_MAX_CONCURRENCY = int(os.getenv("EMBED_MAX_CONCURRENCY") or 4)  # batches in flight
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES") or 6)          # retries per batch on rate limits
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "embeddings.sqlite3")
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES") or 100000)
+
+# Document embeddings survive restarts: unchanged rows are never re-embedded
+EMBEDDING_CACHE = EmbeddingDiskCache(EMBED_CACHE_PATH, max_entries=EMBED_CACHE_MAX_ENTRIES)
+
+# Query embeddings: help-center traffic is dominated by a few hundred repeated questions
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES") or 2000)
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL") or 24 * 3600)
+QUERY_EMBEDDING_CACHE = TTLCache(max_entries=QUERY_CACHE_MAX_ENTRIES, ttl=QUERY_CACHE_TTL)
+
+# Full LLM answers, keyed by normalized question + matched documents' content
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES") or 1000)
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL") or 6 * 3600)
+ANSWER_CACHE = AnswerCache(max_entries=ANSWER_CACHE_MAX_ENTRIES, ttl=ANSWER_CACHE_TTL)
+
+# /build_index and /sync run here, off the request path
+JOB_RUNNER = JobRunner()
+
+# JSON lines on stdout. Debug payloads (citations, match ids...) are only
+# built at LOG_LEVEL=DEBUG; LOG_SAMPLE_RATE keeps that share of requests'
+# DEBUG/INFO lines (warnings and errors are always written)
+LOG_LEVEL = os.getenv("LOG_LEVEL") or "INFO"
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE") or 1.0)
+log = setup_logging("faq_rag", LOG_LEVEL)
+
+register_caches({
+    "query_embeddings": QUERY_EMBEDDING_CACHE,
+    "document_embeddings": EMBEDDING_CACHE,
+    "answers": ANSWER_CACHE
+})
 
 DB_CONFIG = {
     'host': os.getenv('DB_HOST'),
@@ -27,21 +161,189 @@ DB_CONFIG = {
     'password': os.getenv('DB_PASSWORD'),
     'database': os.getenv('DB_DATABASE_HC'),
 }
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE") or 5)  # mysql.connector caps pools at 32
+DB_FETCH_SIZE = int(os.getenv("DB_FETCH_SIZE") or 500)  # rows per fetchmany while streaming questions
+DB_STREAM_WRITE_TIMEOUT = int(os.getenv("DB_STREAM_WRITE_TIMEOUT") or 600)  # s the server waits on a slow reader
+
+LANGUAGE_ALIASES = {"fr": "Français", "en": "English"}
 
 SQL_QUERY = """
-    SELECT id, title, content, post_type, langues, ecoles 
+    SELECT id, title, content, post_type, langues, ecoles, updated_at
     FROM questions
     WHERE status = 'publish'
 """
 
 # ====================================================================
-# FASTAPI INIT
+# SHARED CLIENTS
 # ====================================================================
+# One Elasticsearch client (pooled HTTP transport) and one MySQL connection
+# pool live for the whole application instead of being rebuilt per request.
+
+_es_client = None
+_async_es_client = None
+_async_openai_client = None
+_vector_store = None
+_mysql_pool = None
+_mysql_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+_clients_lock = threading.Lock()
+
+
+def get_es():
+    global _es_client
+    if _es_client is None:
+        with _clients_lock:
+            if _es_client is None:
+                _es_client = Elasticsearch(
+                    [f"http://{ES_HOST}:{ES_PORT}"],
+                    connections_per_node=ES_POOL_SIZE,
+                    request_timeout=ES_REQUEST_TIMEOUT,
+                    retry_on_timeout=True,
+                    max_retries=3
+                )
+    return _es_client
+
+
+def get_async_es():
+    # /ask runs on the event loop: created lazily there, no locking needed
+    global _async_es_client
+    if _async_es_client is None:
+        _async_es_client = AsyncElasticsearch(
+            [f"http://{ES_HOST}:{ES_PORT}"],
+            connections_per_node=ES_POOL_SIZE,
+            request_timeout=ES_REQUEST_TIMEOUT,
+            retry_on_timeout=True,
+            max_retries=3
+        )
+    return _async_es_client
+
+
+def get_async_openai():
+    global _async_openai_client
+    if _async_openai_client is None:
+        _async_openai_client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY)
+    return _async_openai_client
+
+
+def get_vector_store():
+    global _vector_store
+    if _vector_store is None:
+        with _clients_lock:
+            if _vector_store is None:
+                if VECTOR_BACKEND == "local":
+                    _vector_store = LocalVectorStore(LOCAL_INDEX_PATH, LOCAL_INDEX_RELOAD_INTERVAL)
+                else:
+                    _vector_store = ElasticsearchStore(get_async_es, ES_INDEX, vector_search_params)
+    return _vector_store
+
+
+def require_elasticsearch(feature: str):
+    """Reject Elasticsearch-only endpoints with a 400 when VECTOR_BACKEND is another backend."""
+    if VECTOR_BACKEND != "elasticsearch":
+        raise HTTPException(
+            status_code=400,
+            detail=f"{feature} requires VECTOR_BACKEND=elasticsearch (current backend: {VECTOR_BACKEND})"
+        )
+
+
+def get_mysql_pool():
+    global _mysql_pool
+    if _mysql_pool is None:
+        with _clients_lock:
+            if _mysql_pool is None:
+                _mysql_pool = mysql.connector.pooling.MySQLConnectionPool(
+                    pool_name="faq_rag",
+                    pool_size=DB_POOL_SIZE,
+                    pool_reset_session=True,
+                    **DB_CONFIG
+                )
+    return _mysql_pool
+
 
-app = FastAPI(title="FAQ RAG API")
+@contextmanager
+def mysql_connection():
+    """
+    Borrow a pooled MySQL connection and hand it back afterwards.
+    mysql.connector raises instead of waiting when the pool is exhausted,
+    so callers queue on a semaphore sized like the pool.
+    """
+    with _mysql_slots:
+        conn = get_mysql_pool().get_connection()
+        try:
+            # Reconnect transparently if the server dropped an idle connection
+            conn.ping(reconnect=True, attempts=2, delay=0)
+            yield conn
+        finally:
+            conn.close()  # returns the connection to the pool
+
+
+def check_clients() -> dict:
+    """Health of the shared clients: ES ping (or local index presence) and a trivial MySQL query."""
+    health = {}
+    if VECTOR_BACKEND == "local":
+        health["vector_store"] = "ok" if get_vector_store().snapshot() else "empty: run /build_index"
+    else:
+        try:
+            health["elasticsearch"] = "ok" if get_es().ping() else "unreachable"
+        except Exception as e:
+            health["elasticsearch"] = f"error: {e}"
+
+    try:
+        with mysql_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            cursor.close()
+        health["mysql"] = "ok"
+    except Exception as e:
+        health["mysql"] = f"error: {e}"
+
+    return health
+
+
+def close_clients():
+    global _es_client, _mysql_pool
+    with _clients_lock:
+        if _es_client is not None:
+            _es_client.close()
+            _es_client = None
+        if _mysql_pool is not None:
+            # No public close(): this disconnects every idle pooled connection
+            _mysql_pool._remove_connections()
+            _mysql_pool = None
+
+
+async def close_async_clients():
+    global _async_es_client, _async_openai_client
+    if _async_es_client is not None:
+        await _async_es_client.close()
+        _async_es_client = None
+    if _async_openai_client is not None:
+        await _async_openai_client.close()
+        _async_openai_client = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Open the pools up front so the first request does not pay for it,
+    # but keep serving if a backend is down at boot (health shows it)
+    log.info("Startup", extra={"fields": {"clients": await asyncio.to_thread(check_clients)}})
+    get_async_es()
+    get_async_openai()
+    yield
+    JOB_RUNNER.shutdown()
+    await close_async_clients()
+    close_clients()
+    EMBEDDING_CACHE.close()
+    log.info("Shutdown: clients closed")
+
+
+# ====================================================================
+# FASTAPI INIT
+# ====================================================================
 
+app = FastAPI(title="FAQ RAG API", lifespan=lifespan)
 
-# ✅ Configuration CORS - À ajouter juste après la création de l'app
+app.add_middleware(RequestLogMiddleware, logger=log, sample_rate=LOG_SAMPLE_RATE)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -62,75 +364,312 @@ app.add_middleware(
 
 class QuestionRequest(BaseModel):
     message: str
-    top_k: int = 5
+    top_k: int = Field(5, ge=1, le=ASK_MAX_TOP_K)
     use_llm: bool = True  # Enable LLM post-processing by default
+    search_mode: Optional[Literal["knn", "exact", "hybrid"]] = None  # Defaults to ASK_SEARCH_MODE
+    num_candidates: Optional[int] = Field(None, ge=1, le=ES_MAX_NUM_CANDIDATES)  # Defaults to ES_NUM_CANDIDATES
+    # Hybrid mode only, default to the HYBRID_* settings
+    fusion: Optional[Literal["rrf", "weighted"]] = None
+    bm25_weight: Optional[float] = Field(None, ge=0)
+    vector_weight: Optional[float] = Field(None, ge=0)
+    # Optional pre-filters, applied inside the vector query
+    language: Optional[str] = None  # "fr" / "en" or the stored value ("Français", "English")
+    school: Optional[str] = None    # EMLV, ESILV, IIM, EXECUTIVE
+    category: Optional[str] = None  # post_type: question, video, Tutoriel
+
+
+class KnnReportRequest(BaseModel):
+    queries: List[str] = Field(..., min_length=1)
+    top_k: int = Field(5, ge=1, le=ASK_MAX_TOP_K)
+    num_candidates: List[Annotated[int, Field(ge=1, le=ES_MAX_NUM_CANDIDATES)]] = [10, 25, 50, 100, 200]
 
 
 # ====================================================================
 # HELPERS
 # ====================================================================
 
-def get_mysql_rows():
-    conn = mysql.connector.connect(**DB_CONFIG)
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute(SQL_QUERY)
-    rows = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return rows
+def count_mysql_rows() -> int:
+    with mysql_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM questions WHERE status = 'publish'")
+        (count,) = cursor.fetchone()
+        cursor.close()
+    return count
+
+
+def iter_mysql_rows(fetch_size: int = DB_FETCH_SIZE, job=None):
+    """
+    Stream published question rows with an unbuffered cursor: the server
+    sends the result set as it is read, fetch_size rows at a time, so only
+    one batch is held here and downstream stages start on the first batch.
+    The pooled connection stays checked out until the generator is
+    exhausted or closed; unread rows are drained before it goes back.
+    """
+    with mysql_connection() as conn:
+        cursor = conn.cursor(dictionary=True, buffered=False)
+        try:
+            # Embedding can stall the reader for a while; don't let the server drop the stream
+            cursor.execute("SET SESSION net_write_timeout = %s", (DB_STREAM_WRITE_TIMEOUT,))
+            cursor.execute(SQL_QUERY)
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                if job:
+                    job.advance(read=len(rows))
+                yield from rows
+        finally:
+            if conn.unread_result:
+                conn.consume_results()
+            cursor.close()
+
+
+def document_text(row) -> str:
+    """The exact text embedded for a question row (or one of its passages)."""
+    return f"{row['title']} {row['content']}"
+
+
+def row_hash(row) -> str:
+    """
+    Content hash stored with a question's document(s). In passage mode it
+    also covers the passage settings, so changing them re-embeds on /sync.
+    """
+    if INDEX_GRANULARITY == "passage":
+        return content_hash(f"passage:{INDEX_PASSAGE_TOKENS}:{INDEX_PASSAGE_OVERLAP}\n{document_text(row)}")
+    return content_hash(document_text(row))
+
+
+def index_units(row) -> list:
+    """
+    What gets embedded and indexed for a question row: the row itself, or
+    in passage mode one row per passage (content = the passage text) that
+    keeps the question's id and hash.
+    """
+    if INDEX_GRANULARITY != "passage":
+        return [row]
+    passages = split_overlapping(row['content'], INDEX_PASSAGE_TOKENS, INDEX_PASSAGE_OVERLAP, LLM_MODEL) or [("", 0)]
+    parent_hash = row_hash(row)
+    return [
+        {**row, "content": text, "passage": position, "overlap": overlap, "row_hash": parent_hash}
+        for position, (text, overlap) in enumerate(passages)
+    ]
+
+
+def iter_index_units(rows):
+    for row in rows:
+        yield from index_units(row)
 
 
-def generate_embedding(text: str):
-    response = openai.embeddings.create(
-        model="text-embedding-3-small",
+async def generate_embedding(text: str):
+    response = await get_async_openai().embeddings.create(
+        model=EMBEDDING_MODEL,
         input=text
     )
+    record_usage(EMBEDDING_MODEL, response.usage)
     return response.data[0].embedding
 
 
-def llm_process_results(user_query: str, matches: list):
+async def embed_query(query: str):
     """
-    Use LLM to synthesize an answer from the top Elasticsearch matches,
-    following a standardized JSON output schema for front-end consumption.
+    Embedding for a user question, served from QUERY_EMBEDDING_CACHE when a
+    question with the same normalized text was embedded recently.
+    Returns (embedding, cache_hit).
     """
-    print("[LLM] Starting llm_process_results")
-    print(f"[LLM] User query: {user_query}")
-    print(f"[LLM] Number of matches: {len(matches)}")
+    key = (EMBEDDING_MODEL, normalize_query(query))
+    embedding = QUERY_EMBEDDING_CACHE.get(key)
+    if embedding is not None:
+        return embedding, True
+
+    embedding = await generate_embedding(query)
+    QUERY_EMBEDDING_CACHE.put(key, embedding)
+    return embedding, False
+
+
+def embedding_retry_delay(attempt: int, error: Exception) -> float:
+    """
+    Seconds to wait before retrying a batch: honor the Retry-After header
+    when OpenAI sends one, otherwise exponential backoff with jitter.
+    """
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return min(2 ** attempt, 30) + random.uniform(0, 1)
+
+
+def embed_batch(texts: list):
+    """
+    Embed one batch of texts in a single API call.
+    Returns (embeddings, retries) with embeddings in input order.
+    """
+    retries = 0
+    while True:
+        try:
+            response = openai.embeddings.create(model=EMBEDDING_MODEL, input=texts)
+            record_usage(EMBEDDING_MODEL, response.usage)
+            ordered = sorted(response.data, key=lambda item: item.index)
+            return [item.embedding for item in ordered], retries
+        except (openai.RateLimitError, openai.APIConnectionError) as e:
+            if retries >= EMBED_MAX_RETRIES:
+                raise
+            time.sleep(embedding_retry_delay(retries, e))
+            retries += 1
+
+
+def generate_embeddings(texts: list):
+    """
+    Embed many texts. Texts already in EMBEDDING_CACHE are served from disk;
+    the rest are embedded with batched API calls, keeping at most
+    EMBED_MAX_CONCURRENCY batches in flight at once, then written back.
+    Returns (embeddings, stats) with embeddings in input order.
+    """
+    embeddings = EMBEDDING_CACHE.get_many(EMBEDDING_MODEL, texts)
+    cache_hits = sum(1 for e in embeddings if e is not None)
+    missing = list(dict.fromkeys(text for text, e in zip(texts, embeddings) if e is None))
+
+    batches = [missing[i:i + EMBED_BATCH_SIZE] for i in range(0, len(missing), EMBED_BATCH_SIZE)]
+    fresh = {}
+    retries = 0
+
+    with ThreadPoolExecutor(max_workers=EMBED_MAX_CONCURRENCY) as pool:
+        for batch, (batch_embeddings, batch_retries) in zip(batches, pool.map(embed_batch, batches)):
+            EMBEDDING_CACHE.put_many(EMBEDDING_MODEL, batch, batch_embeddings)
+            fresh.update(zip(batch, batch_embeddings))
+            retries += batch_retries
+
+    embeddings = [e if e is not None else fresh[text] for text, e in zip(texts, embeddings)]
+
+    return embeddings, {
+        "batches": len(batches),
+        "retries": retries,
+        "cache_hits": cache_hits,
+        "cache_misses": len(texts) - cache_hits
+    }
+
+
+def search_filters(language: str = None, school: str = None, category: str = None):
+    """Required values of the keyword fields written by build_document, as {field: value}."""
+    filters = {}
+    if language:
+        filters["language"] = LANGUAGE_ALIASES.get(language.lower(), language)
+    if school:
+        filters["schools"] = school.upper()
+    if category:
+        filters["category"] = category
+    return filters
 
-    # ✅ Handle no matches
-    if not matches:
-        print("[LLM] No matches found, returning fallback response")
 
+def vector_search_params(query_embedding: list, top_k: int, mode: str = None, num_candidates: int = None, filters: dict = None):
+    """
+    es.search keyword arguments for a vector query: approximate HNSW kNN by
+    default, or an exact script_score scan over every document. Both score
+    as (1 + cosine) / 2 so results are comparable across modes.
+
+    Filters are pre-filters: kNN only walks matching documents and the
+    exact scan only scores them, so top_k is always filled when possible.
+    """
+    mode = mode or ASK_SEARCH_MODE
+    filters = term_filters(filters)
+    if mode == "exact":
         return {
-            "language": "fr",
-            "answered": False,
-            "answer_html": "<p>Je n’ai pas trouvé d’information fiable dans la base de connaissances.</p>"
-                           "<p>Pour obtenir une réponse, utilise ce canal : "
-                           "<a href='https://example.com/contact'>Formulaire de contact</a>.</p>",
-            "reason_if_unanswered": "Aucun extrait pertinent n'a été trouvé.",
-            "used_source_ids": [],
-            "citations": [],
-            "meta": {"query_echo": user_query, "notes": "No matches found"},
-            "redirect": {
-                "needed": True,
-                "label": "Formulaire de contact",
-                "url": "https://example.com/contact"
+            "query": {
+                "script_score": {
+                    "query": {"bool": {"filter": filters}} if filters else {"match_all": {}},
+                    "script": {
+                        "source": "(cosineSimilarity(params.query_vector, 'embedding') + 1.0) / 2.0",
+                        "params": {"query_vector": query_embedding}
+                    }
+                }
             }
         }
 
-    # ✅ Build structured context for LLM
-    print("[LLM] Building excerpts from matches...")
-    excerpts = [
-        {
-            "id": match["id"],
-            "title": match["question"],
-            "url": None,
-            "content": match["answer"],
-            "language": "fr"  # Adapt if your data includes 'langues'
+    return {
+        "knn": {
+            "field": "embedding",
+            "query_vector": query_embedding,
+            "k": top_k,
+            "num_candidates": max(num_candidates or ES_NUM_CANDIDATES, top_k),
+            **({"filter": {"bool": {"filter": filters}}} if filters else {})
         }
-        for match in matches
-    ]
-    print(f"[LLM] Built {len(excerpts)} excerpts")
+    }
+
+
+def hybrid_params(payload) -> dict:
+    """Fusion settings of a hybrid /ask: request overrides, else HYBRID_* defaults."""
+    return {
+        "method": payload.fusion or HYBRID_FUSION,
+        "rrf_k": HYBRID_RRF_K,
+        "window": HYBRID_WINDOW,
+        "bm25_weight": HYBRID_BM25_WEIGHT if payload.bm25_weight is None else payload.bm25_weight,
+        "vector_weight": HYBRID_VECTOR_WEIGHT if payload.vector_weight is None else payload.vector_weight
+    }
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def with_timeout(awaitable, seconds: float, stage: str):
+    """Await one /ask stage, turning a blown budget into a 504."""
+    try:
+        return await asyncio.wait_for(awaitable, timeout=seconds)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"{stage} timed out after {seconds:g}s")
+
+
+async def run_until_disconnected(request: Request, coro):
+    """
+    Run coro while watching the client connection; if the client goes away
+    first, cancel the work (and its in-flight OpenAI/ES calls).
+    """
+    async def wait_for_disconnect():
+        while not await request.is_disconnected():
+            await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
+    work = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(wait_for_disconnect())
+    try:
+        await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not work.done():
+            work.cancel()
+
+    if work.cancelled():
+        raise ClientDisconnected()
+    return work.result()
+
+
+def no_match_response(user_query: str):
+    return {
+        "language": "fr",
+        "answered": False,
+        "answer_html": "<p>Je n’ai pas trouvé d’information fiable dans la base de connaissances.</p>"
+                       "<p>Pour obtenir une réponse, utilise ce canal : "
+                       "<a href='https://example.com/contact'>Formulaire de contact</a>.</p>",
+        "reason_if_unanswered": "Aucun extrait pertinent n'a été trouvé.",
+        "used_source_ids": [],
+        "citations": [],
+        "meta": {"query_echo": user_query, "notes": "No matches found"},
+        "redirect": {
+            "needed": True,
+            "label": "Formulaire de contact",
+            "url": "https://example.com/contact"
+        }
+    }
+
+
+def build_llm_messages(user_query: str, matches: list):
+    """System + user messages asking the LLM for the standardized JSON answer."""
+    # ✅ Build structured context for LLM, trimmed to the token budget
+    excerpts, context_stats = build_context(
+        user_query, matches, LLM_CONTEXT_BUDGET, LLM_PASSAGE_TOKENS, LLM_MAX_PASSAGES, LLM_MODEL
+    )
+    record_context(context_stats)
+    log.debug("Built %d LLM excerpts", len(excerpts), extra={"fields": context_stats})
 
     fallback = {"label": "Formulaire de contact", "url": "https://example.com/contact"}
 
@@ -171,313 +710,1195 @@ def llm_process_results(user_query: str, matches: list):
         "fallback": fallback
     }
 
-    # ✅ LLM call with response_format for JSON
-    print("[LLM] Calling OpenAI API...")
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": json.dumps(user_prompt, ensure_ascii=False)}
+    ]
+
+
+def parse_llm_content(content: str, user_query: str, matches: list):
+    """Parse the model output, wrapping it as HTML if it is not strict JSON."""
+    if verbose(log):
+        log.debug("LLM raw response", extra={"fields": {"content": content[:200]}})
+
+    # ✅ Parse JSON safely
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": json.dumps(user_prompt, ensure_ascii=False)}
-            ],
-            temperature=0.2,
-            max_tokens=800,
-            response_format={"type": "json_object"}  # Force JSON output
-        )
+        return json.loads(content)
+    except json.JSONDecodeError:
+        log.warning("LLM response is not valid JSON, wrapping it as HTML")
+
+    # fallback if not strictly JSON
+    # Wrap answers in <p> tags if not already HTML
+    citations_with_wrapped_answers = []
+    for m in matches:
+        answer = m['answer']
+        if answer and not answer.strip().startswith('<'):
+            answer = f"<p>{answer}</p>"
+        citations_with_wrapped_answers.append({
+            "id": m['id'],
+            "title": m['question'],
+            "url": None,
+            "answer": answer
+        })
 
-        print("[LLM] Received response from OpenAI")
-        content = response.choices[0].message.content.strip()
+    return {
+        "language": "fr",
+        "answered": True,
+        "answer_html": f"<p>{content}</p>",
+        "reason_if_unanswered": None,
+        "used_source_ids": [m['id'] for m in matches],
+        "citations": citations_with_wrapped_answers,
+        "meta": {"query_echo": user_query, "notes": "Non-JSON fallback"},
+        "redirect": {"needed": False, "label": None, "url": None}
+    }
 
-        print("[LLM] Raw Response:", content[:200] + "..." if len(content) > 200 else content)
 
-        # ✅ Parse JSON safely
-        print("[LLM] Parsing JSON response...")
-        try:
-            result_json = json.loads(content)
-            print("[LLM] JSON parsed successfully")
-        except json.JSONDecodeError:
-            print("[LLM] JSON parsing failed, using fallback")
-            # fallback if not strictly JSON
-            # Wrap answers in <p> tags if not already HTML
-            citations_with_wrapped_answers = []
-            for m in matches:
-                answer = m['answer']
-                if answer and not answer.strip().startswith('<'):
-                    answer = f"<p>{answer}</p>"
-                citations_with_wrapped_answers.append({
-                    "id": m['id'],
-                    "title": m['question'],
-                    "url": None,
-                    "answer": answer
-                })
-
-            result_json = {
-                "language": "fr",
-                "answered": True,
-                "answer_html": f"<p>{content}</p>",
-                "reason_if_unanswered": None,
-                "used_source_ids": [m['id'] for m in matches],
-                "citations": citations_with_wrapped_answers,
-                "meta": {"query_echo": user_query, "notes": "Non-JSON fallback"},
-                "redirect": {"needed": False, "label": None, "url": None}
-            }
+def enrich_citations(result_json: dict, matches: list):
+    """Attach the full answer content (and score) of each cited match, in place."""
+    debug = verbose(log)
+    if "citations" in result_json and result_json["citations"]:
+        # Create a map of id -> match for quick lookup
+        # Support both string and int IDs for flexible matching
+        match_map = {}
+        for m in matches:
+            match_map[m['id']] = m
+            match_map[str(m['id'])] = m  # Also add string version of ID
+
+        if debug:
+            log.debug("Enriching citations", extra={"fields": {
+                "match_ids": [m["id"] for m in matches],
+                "citation_ids": [c.get("id") for c in result_json["citations"]]
+            }})
+
+        # Add answer content to each citation
+        for citation in result_json["citations"]:
+            citation_id = citation.get("id")
+
+            # Try to find match with both original ID and string version
+            matched_item = match_map.get(citation_id) or match_map.get(str(citation_id))
+
+            # Always ensure the citation has an "answer" field
+            if matched_item:
+                answer_content = matched_item["answer"]
+            else:
+                # If ID not found in matches, check if citation already has an answer
+                answer_content = citation.get("answer")
+                if not answer_content:
+                    log.warning("Citation %s matches no retrieved document", citation_id)
+                    answer_content = "Contenu non disponible"
+                elif debug:
+                    log.debug("Citation %s not retrieved, keeping the answer it carries", citation_id)
+
+            # If answer doesn't already start with HTML tags, wrap it in <p>
+            if answer_content and not answer_content.strip().startswith('<'):
+                answer_content = f"<p>{answer_content}</p>"
+
+            citation["answer"] = answer_content
+
+            # Add score if available from match
+            if matched_item:
+                citation["score"] = matched_item.get("score")
+
+    if debug:
+        log.debug("Enriched citations", extra={"fields": {"citations": result_json.get("citations", [])}})
+    return result_json
+
+
+def llm_error_fallback(user_query: str, matches: list, error: Exception):
+    """Best match returned as-is when the LLM call fails or times out."""
+    log.error("LLM call failed, answering with the best match", extra={"fields": {"error": repr(error)}})
+
+    # Fallback to the best match if API fails
+    fallback_answer = matches[0]["answer"]
+    # Wrap in <p> if not already HTML
+    if fallback_answer and not fallback_answer.strip().startswith('<'):
+        fallback_answer = f"<p>{fallback_answer}</p>"
 
-        # ✅ Enrich citations with full answer content from matches
-        print("[LLM] Enriching citations with answer content...")
-        if "citations" in result_json and result_json["citations"]:
-            # Create a map of id -> match for quick lookup
-            # Support both string and int IDs for flexible matching
-            match_map = {}
-            for m in matches:
-                match_map[m['id']] = m
-                match_map[str(m['id'])] = m  # Also add string version of ID
-
-            print(f"DEBUG: Match map keys: {list(match_map.keys())}")
-            print(f"DEBUG: Citation IDs before enrichment: {[c.get('id') for c in result_json['citations']]}")
-
-            # Add answer content to each citation
-            for citation in result_json["citations"]:
-                citation_id = citation.get("id")
-
-                # Try to find match with both original ID and string version
-                matched_item = match_map.get(citation_id) or match_map.get(str(citation_id))
-
-                # Always ensure the citation has an "answer" field
-                if matched_item:
-                    answer_content = matched_item["answer"]
-                    print(f"DEBUG: Found match for citation ID {citation_id}, answer length: {len(answer_content) if answer_content else 0}")
-                else:
-                    # If ID not found in matches, check if citation already has an answer
-                    answer_content = citation.get("answer")
-                    if not answer_content:
-                        print(f"WARNING: No match found for citation ID {citation_id} and no existing answer")
-                        answer_content = "Contenu non disponible"
-                    else:
-                        print(f"DEBUG: No match for citation ID {citation_id}, using existing answer from citation")
+    return {
+        "language": "fr",
+        "answered": True,
+        "answer_html": fallback_answer,
+        "reason_if_unanswered": None,
+        "used_source_ids": [matches[0]["id"]],
+        "citations": [{"id": matches[0]["id"], "title": matches[0]["question"], "url": None, "answer": fallback_answer, "score": matches[0].get("score")}],
+        "meta": {"query_echo": user_query, "notes": "LLM error fallback"},
+        "redirect": {"needed": False, "label": None, "url": None},
+        "error": str(error) or type(error).__name__
+    }
+
+
+async def llm_process_results(user_query: str, matches: list):
+    """
+    Use LLM to synthesize an answer from the top Elasticsearch matches,
+    following a standardized JSON output schema for front-end consumption.
+    """
+    # ✅ Handle no matches
+    if not matches:
+        log.info("No matches, returning the contact fallback")
+        return no_match_response(user_query)
 
-                # If answer doesn't already start with HTML tags, wrap it in <p>
-                if answer_content and not answer_content.strip().startswith('<'):
-                    answer_content = f"<p>{answer_content}</p>"
+    messages = build_llm_messages(user_query, matches)
 
-                citation["answer"] = answer_content
+    # ✅ LLM call with response_format for JSON
+    try:
+        with stage_timer("llm_synthesis"):
+            response = await asyncio.wait_for(
+                get_async_openai().chat.completions.create(
+                    model=LLM_MODEL,
+                    messages=messages,
+                    temperature=0.2,
+                    max_tokens=LLM_MAX_TOKENS,
+                    response_format={"type": "json_object"}  # Force JSON output
+                ),
+                timeout=ASK_LLM_TIMEOUT
+            )
+        record_usage(LLM_MODEL, response.usage)
 
-                # Add score if available from match
-                if matched_item:
-                    citation["score"] = matched_item.get("score")
+        content = response.choices[0].message.content.strip()
 
-        # Debug: Print citations to verify answer field is present
-        print("[LLM] Enriched citations:", json.dumps(result_json.get("citations", []), ensure_ascii=False, indent=2)[:500] + "...")
+        result_json = parse_llm_content(content, user_query, matches)
+        with stage_timer("citation_enrichment"):
+            enrich_citations(result_json, matches)
 
-        print("[LLM] Returning result_json")
         return result_json
 
     except Exception as e:
-        print(f"[LLM] ERROR: {str(e)}")
+        return llm_error_fallback(user_query, matches, e)
 
-        # Fallback to the best match if API fails
-        fallback_answer = matches[0]["answer"]
-        # Wrap in <p> if not already HTML
-        if fallback_answer and not fallback_answer.strip().startswith('<'):
-            fallback_answer = f"<p>{fallback_answer}</p>"
 
-        return {
-            "language": "fr",
-            "answered": True,
-            "answer_html": fallback_answer,
-            "reason_if_unanswered": None,
-            "used_source_ids": [matches[0]["id"]],
-            "citations": [{"id": matches[0]["id"], "title": matches[0]["question"], "url": None, "answer": fallback_answer, "score": matches[0].get("score")}],
-            "meta": {"query_echo": user_query, "notes": "LLM error fallback"},
-            "redirect": {"needed": False, "label": None, "url": None},
-            "error": str(e)
-        }
+JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
 
+class AnswerHtmlExtractor:
+    """
+    Follows the LLM's JSON output as it streams in and returns the decoded
+    text of its "answer_html" string as soon as each piece arrives, so it can
+    be forwarded before the whole object is complete. The full raw output is
+    kept in .text for the final parse.
+    """
 
-def index_document(es, row, embedding):
-    es.index(index=ES_INDEX, id=row['id'], document={
+    FIELD = re.compile(r'"answer_html"\s*:\s*"')
+
+    def __init__(self):
+        self.text = ""
+        self._pos = None   # next undecoded character of the answer_html value
+        self._done = False
+
+    def feed(self, chunk: str) -> str:
+        self.text += chunk
+        if self._done:
+            return ""
+
+        if self._pos is None:
+            match = self.FIELD.search(self.text)
+            if not match:
+                return ""
+            self._pos = match.end()
+
+        out = []
+        buf = self.text
+        i = self._pos
+        while i < len(buf):
+            c = buf[i]
+            if c == '"':
+                self._done = True
+                i += 1
+                break
+            if c != '\\':
+                out.append(c)
+                i += 1
+                continue
+
+            # Escape sequence: wait for the rest of it to arrive
+            if i + 1 >= len(buf):
+                break
+            if buf[i + 1] != 'u':
+                out.append(JSON_ESCAPES.get(buf[i + 1], buf[i + 1]))
+                i += 2
+                continue
+            if i + 6 > len(buf):
+                break
+            code = int(buf[i + 2:i + 6], 16)
+            if 0xD800 <= code < 0xDC00:
+                # High surrogate: decode together with the low half
+                if i + 12 > len(buf):
+                    break
+                low = int(buf[i + 8:i + 12], 16)
+                out.append(chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)))
+                i += 12
+            else:
+                out.append(chr(code))
+                i += 6
+
+        self._pos = i
+        return "".join(out)
+
+
+def split_keywords(value):
+    """'EMLV ESILV IIM' -> ['EMLV', 'ESILV', 'IIM'] so each school is its own keyword."""
+    if not value:
+        return []
+    return [token for token in re.split(r"[\s,;|]+", value) if token]
+
+
+def build_document(row, embedding):
+    return {
         "id": row['id'],
         "question": row['title'],
         "answer": row['content'],
         "embedding": embedding,
         "category": row.get("post_type"),
         "language": row.get("langues"),
-        "schools": row.get("ecoles")
-    })
+        "schools": split_keywords(row.get("ecoles")),
+        "content_hash": row.get("row_hash") or row_hash(row),
+        "updated_at": row.get("updated_at"),
+        **({"passage": row["passage"], "overlap": row["overlap"]} if "passage" in row else {})
+    }
+
+
+def document_id(row):
+    """_id of a row's document: the question id, suffixed with the passage number in passage mode."""
+    return f"{row['id']}_{row['passage']}" if "passage" in row else row['id']
+
+
+def question_id(doc_id) -> int:
+    return int(str(doc_id).split("_", 1)[0])
+
+
+def index_actions(rows, embeddings, index=ES_INDEX):
+    """Yield one _bulk index action per (row, embedding) pair."""
+    for row, embedding in zip(rows, embeddings):
+        yield {
+            "_op_type": "index",
+            "_index": index,
+            "_id": document_id(row),
+            "_source": build_document(row, embedding)
+        }
+
+
+def bulk_index(es, actions, chunk_size=ES_BULK_CHUNK_SIZE, job=None):
+    """
+    Stream actions through the _bulk API in chunks of chunk_size.
+    Failed items do not abort the run; they are collected and returned.
+    Returns (succeeded, errors).
+    """
+    succeeded = 0
+    errors = []
+
+    for ok, item in helpers.streaming_bulk(
+        es,
+        actions,
+        chunk_size=chunk_size,
+        max_retries=ES_BULK_MAX_RETRIES,
+        raise_on_error=False,
+        raise_on_exception=False
+    ):
+        op_type, detail = next(iter(item.items()))
+        # Deleting a document that is already gone is not a failure
+        if job:
+            job.check_cancelled()
+        if ok or (op_type == "delete" and detail.get("status") == 404):
+            succeeded += 1
+            if job:
+                job.advance(indexed=1)
+            continue
+        if job:
+            job.advance(failed=1)
+        errors.append({
+            "op": op_type,
+            "id": detail.get("_id"),
+            "status": detail.get("status"),
+            "error": detail.get("error") or str(detail.get("exception"))
+        })
+
+    return succeeded, errors
+
+
+def delete_actions(ids, index=ES_INDEX):
+    for doc_id in ids:
+        yield {"_op_type": "delete", "_index": index, "_id": doc_id}
+
+
+def delete_questions(es, ids, index=ES_INDEX, chunk_size=SYNC_PAGE_SIZE):
+    """
+    Remove every indexed document of these question ids. Passage documents
+    are found by their id field with _delete_by_query, a chunk of ids at a
+    time. Returns (deleted, errors) like bulk_index.
+    """
+    if INDEX_GRANULARITY != "passage":
+        return bulk_index(es, delete_actions(ids, index))
+
+    ids = sorted(ids)
+    deleted = 0
+    errors = []
+    for i in range(0, len(ids), chunk_size):
+        resp = es.delete_by_query(
+            index=index,
+            query={"terms": {"id": ids[i:i + chunk_size]}},
+            conflicts="proceed",
+            refresh=False
+        )
+        deleted += resp.get("deleted", 0)
+        errors.extend({"op": "delete_by_query", "error": failure} for failure in resp.get("failures", []))
+    return deleted, errors
+
+
+def iter_rows_by_ids(ids, chunk_size=PIPELINE_CHUNK_SIZE):
+    """
+    Yield question rows for ids one chunk at a time, each chunk fetched with
+    a parameterized IN (%s, ...) query of at most chunk_size ids.
+    """
+    ids = sorted(ids)
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        placeholders = ", ".join(["%s"] * len(chunk))
+        with mysql_connection() as conn:
+            cursor = conn.cursor(dictionary=True)
+            cursor.execute(f"""
+                SELECT id, title, content, post_type, langues, ecoles, updated_at
+                FROM questions
+                WHERE id IN ({placeholders})
+            """, chunk)
+            rows = cursor.fetchall()
+            cursor.close()
+        # Connection is back in the pool before downstream stages run
+        yield rows
+
+
+def chunked(iterable, size: int = PIPELINE_CHUNK_SIZE):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def embed_row_chunks(row_chunks, stats: dict, job=None):
+    """Pipeline stage: (rows) -> (rows, embeddings), accumulating embedding stats."""
+    for rows in row_chunks:
+        if job:
+            job.check_cancelled()
+        if not rows:
+            continue
+        embeddings, chunk_stats = generate_embeddings([document_text(row) for row in rows])
+        for key, value in chunk_stats.items():
+            stats[key] = stats.get(key, 0) + value
+        if job:
+            job.advance(embedded=len(rows))
+        yield rows, embeddings
+
+
+def embedded_index_actions(embedded_chunks, index=ES_INDEX):
+    """Pipeline stage: (rows, embeddings) -> _bulk index actions."""
+    for rows, embeddings in embedded_chunks:
+        yield from index_actions(rows, embeddings, index)
+
+
+class _PipelineFailure:
+    def __init__(self, error):
+        self.error = error
+
+
+def prefetch(iterable, depth: int = 2):
+    """
+    Drive iterable from a background thread, buffering up to depth items,
+    so an upstream stage (MySQL fetch, embedding) works on the next chunk
+    while the consumer (bulk indexing) handles the current one. When the
+    consumer stops, the producer stops too and closes iterable, so upstream
+    generators release their MySQL connection before prefetch returns.
+    """
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_PipelineFailure(e))
+        finally:
+            put(done)
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                return
+            if isinstance(item, _PipelineFailure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def ensure_index(es, index=ES_INDEX):
+    """Create the index, or add any mapping fields introduced since it was created."""
+    if not es.indices.exists(index=index):
+        es.indices.create(index=index, mappings=INDEX_MAPPINGS)
+    else:
+        es.indices.put_mapping(index=index, properties=INDEX_MAPPINGS["properties"])
+
+
+def iter_index_state(es, index=ES_INDEX, page_size=SYNC_PAGE_SIZE):
+    """
+    Yield (id, content_hash) for every indexed document, paging with a point
+    in time and search_after so the walk is consistent and never capped.
+    """
+    pit = es.open_point_in_time(index=index, keep_alive="2m")["id"]
+    search_after = None
+    try:
+        while True:
+            resp = es.search(
+                pit={"id": pit, "keep_alive": "2m"},
+                size=page_size,
+                sort=[{"_shard_doc": "asc"}],
+                _source=["id", "content_hash"],
+                search_after=search_after
+            )
+            hits = resp["hits"]["hits"]
+            if not hits:
+                return
+            # Passage documents repeat their question's id and hash
+            for hit in hits:
+                yield question_id(hit["_source"].get("id", hit["_id"])), hit["_source"].get("content_hash")
+            pit = resp.get("pit_id", pit)
+            search_after = hits[-1]["sort"]
+    finally:
+        es.close_point_in_time(id=pit)
+
+
+def index_high_water_mark(es, index=ES_INDEX):
+    """Latest questions.updated_at already indexed, or None for an empty/legacy index."""
+    resp = es.search(index=index, size=0, aggs={"hwm": {"max": {"field": "updated_at"}}})
+    value = resp["aggregations"]["hwm"]["value"]
+    if value is None:
+        return None
+    # Naive MySQL datetimes are indexed as-is (read as UTC): convert back the same way
+    return datetime.fromtimestamp(value / 1000, tz=timezone.utc).replace(tzinfo=None)
+
+
+# --------------------------------------------------------------------
+# Blue/green generations: ES_INDEX is an alias over ES_INDEX_<timestamp>
+# --------------------------------------------------------------------
+
+def index_generations(es):
+    """Versioned indices behind ES_INDEX, oldest first (names sort by timestamp)."""
+    return sorted(es.indices.get(index=f"{ES_INDEX}_*", expand_wildcards="open").keys())
+
+
+def alias_targets(es):
+    if not es.indices.exists_alias(name=ES_INDEX):
+        return []
+    return sorted(es.indices.get_alias(name=ES_INDEX).keys())
+
+
+def point_alias(es, target: str):
+    """Atomically move the ES_INDEX alias onto target."""
+    actions = [{"remove": {"index": old, "alias": ES_INDEX}} for old in alias_targets(es) if old != target]
+    if es.indices.exists(index=ES_INDEX) and not es.indices.exists_alias(name=ES_INDEX):
+        # First switch: a concrete index still owns the name, drop it in the same call
+        actions.append({"remove_index": {"index": ES_INDEX}})
+    actions.append({"add": {"index": target, "alias": ES_INDEX, "is_write_index": True}})
+    es.indices.update_aliases(actions=actions)
+
+
+def blue_green_load(es, make_actions, job=None):
+    """
+    Load a fresh generation with replicas=0 and refresh off, restore
+    replicas/refresh, force-merge, then swap the alias onto it. The live
+    index is untouched until the swap; any failure (or cancellation)
+    discards the new one. make_actions(index) yields the _bulk actions.
+    Returns (new_index, count, errors, dropped).
+    """
+    new_index = f"{ES_INDEX}_{datetime.now(timezone.utc):%Y%m%d%H%M%S}"
+    es.indices.create(
+        index=new_index,
+        mappings=INDEX_MAPPINGS,
+        settings={"number_of_replicas": 0, "refresh_interval": "-1"}
+    )
+
+    try:
+        count, errors = bulk_index(es, make_actions(new_index), job=job)
+        if errors:
+            es.indices.delete(index=new_index)
+            return None, count, errors, []
+
+        es.indices.put_settings(
+            index=new_index,
+            settings={"index": {"refresh_interval": None, "number_of_replicas": ES_REPLICAS}}
+        )
+        es.indices.refresh(index=new_index)
+        es.options(request_timeout=600).indices.forcemerge(index=new_index, max_num_segments=1)
+        es.cluster.health(index=new_index, wait_for_status="yellow", timeout="60s")
+        previous = alias_targets(es)
+        point_alias(es, new_index)
+    except Exception:
+        es.indices.delete(index=new_index, ignore_unavailable=True)
+        raise
+
+    # Keep the newest ES_KEEP_PREVIOUS older generations for rollback, and
+    # never the one that was live until this swap (the last known-good one)
+    older = [name for name in index_generations(es) if name < new_index]
+    dropped = [name for name in older[:max(len(older) - ES_KEEP_PREVIOUS, 0)] if name not in previous]
+    if dropped:
+        es.indices.delete(index=",".join(dropped))
+
+    return new_index, count, errors, dropped
+
+
+@contextmanager
+def refresh_disabled(es, index=ES_INDEX):
+    """
+    Turn periodic refresh off while bulk loading, then restore the previous
+    refresh_interval (or the cluster default) and refresh once at the end.
+    """
+    settings = es.indices.get_settings(index=index, name="index.refresh_interval")
+    previous = next(iter(settings.values()), {}).get("settings", {}).get("index", {}).get("refresh_interval")
+
+    es.indices.put_settings(index=index, settings={"index": {"refresh_interval": "-1"}})
+    try:
+        yield
+    finally:
+        es.indices.put_settings(index=index, settings={"index": {"refresh_interval": previous}})
+        es.indices.refresh(index=index)
+
+
+# --------------------------------------------------------------------
+# Local backend (VECTOR_BACKEND=local): memory-mapped NumPy index
+# --------------------------------------------------------------------
+
+def run_local_index(job, incremental: bool = False):
+    """
+    Write a new generation of the local index from every published row.
+    incremental (/sync) reuses the live generation's vector(s) of each row
+    whose text is unchanged, so only new or edited rows are embedded.
+    """
+    store = get_vector_store()
+
+    started = time.perf_counter()
+    job.set_total(count_mysql_rows())
+
+    previous = store.stored_vectors() if incremental else {}
+    documents = []
+    seen_ids = set()
+    changed_ids = set()
+
+    def changed_units():
+        # Rows stream in from MySQL; unchanged ones are kept as documents
+        # straight away, the rest go on to the embedding stage
+        for row in iter_mysql_rows(job=job):
+            seen_ids.add(row['id'])
+            kept = previous.get(row['id'])
+            units = index_units(row)
+            if kept and kept[0] == row_hash(row) and len(kept[1]) == len(units):
+                documents.extend(build_document(unit, vector) for unit, vector in zip(units, kept[1]))
+            else:
+                changed_ids.add(row['id'])
+                yield from units
+
+    stats = {}
+    for chunk, embeddings in prefetch(embed_row_chunks(chunked(changed_units()), stats, job)):
+        documents.extend(build_document(row, embedding) for row, embedding in zip(chunk, embeddings))
+
+    job.check_cancelled()
+    generation = write_local_index(
+        LOCAL_INDEX_PATH, documents, INDEX_MAPPINGS["properties"]["embedding"]["dims"], LOCAL_INDEX_DTYPE
+    )
+    job.advance(indexed=len(documents))
+    elapsed = time.perf_counter() - started
+
+    deleted = set(previous) - seen_ids
+    if incremental:
+        ANSWER_CACHE.invalidate_ids(deleted | changed_ids)
+    else:
+        ANSWER_CACHE.clear()
+
+    return {
+        "status": "ok",
+        "mode": "local",
+        "generation": generation,
+        "checked": len(seen_ids),
+        "indexed": len(documents),
+        "embedded": len(changed_ids),
+        "added": len(changed_ids - set(previous)),
+        "updated": len(changed_ids & set(previous)),
+        "deleted": len(deleted),
+        "throughput": {
+            "seconds": round(elapsed, 2),
+            "docs_per_s": round(len(documents) / elapsed, 1) if elapsed else None,
+            "batches": stats.get("batches", 0),
+            "retries": stats.get("retries", 0)
+        },
+        "embedding_cache": {
+            "hits": stats.get("cache_hits", 0),
+            "misses": stats.get("cache_misses", 0)
+        }
+    }
 
 
 # ====================================================================
 # ✅ API 1 : BUILD INDEX + EMBEDDINGS
 # ====================================================================
 
-@app.post("/build_index")
-def build_index():
-    es = Elasticsearch([f"http://{ES_HOST}:{ES_PORT}"])
-
-    # Create index if not exists
-    if not es.indices.exists(index=ES_INDEX):
-        es.indices.create(
-            index=ES_INDEX,
-            mappings={
-                "properties": {
-                    "id": {"type": "keyword"},
-                    "question": {"type": "text"},
-                    "answer": {"type": "text"},
-                    "embedding": {
-                        "type": "dense_vector",
-                        "dims": 1536,
-                        "index": True,
-                        "similarity": "cosine"
-                    },
-                    "category": {"type": "keyword"},
-                    "language": {"type": "keyword"},
-                    "schools": {"type": "keyword"}
-                }
-            }
-        )
+def run_build_index(job, mode: str = "inplace"):
+    """
+    Full rebuild. inplace rewrites the live index; bluegreen loads a new
+    versioned index and swaps the ES_INDEX alias onto it once it is ready.
+    Rows are embedded and indexed chunk by chunk, reporting to job.
+    With VECTOR_BACKEND=local, writes a new local index generation instead
+    (build_index rejects bluegreen there).
+    """
+    if VECTOR_BACKEND == "local":
+        return run_local_index(job)
+
+    es = get_es()
+
+    started = time.perf_counter()
+    # Passage documents outnumber rows: the ETA then follows rows read
+    job.set_total(count_mysql_rows(), counter="read" if INDEX_GRANULARITY == "passage" else "indexed")
+
+    stats = {}
+    delete_errors = []
+
+    def unit_chunks(index, clear_passages):
+        for rows in chunked(iter_mysql_rows(job=job)):
+            if clear_passages:
+                # Rewriting in place only overwrites <id>_<n>: drop the question's
+                # previous passages first (shorter article, other passage settings)
+                _, errors = delete_questions(es, [row['id'] for row in rows], index)
+                delete_errors.extend(errors)
+            yield [unit for row in rows for unit in index_units(row)]
+
+    def make_actions(index=ES_INDEX, clear_passages=False):
+        # Rows stream from MySQL into embedding; embedding of the next chunk
+        # overlaps with indexing of the current one
+        embedded = prefetch(embed_row_chunks(unit_chunks(index, clear_passages), stats, job))
+        return embedded_index_actions(embedded, index)
+
+    generation = {}
+    if mode == "bluegreen":
+        new_index, count, errors, dropped = blue_green_load(es, make_actions, job)
+        generation = {"index": new_index, "dropped": dropped}
+        status = "ok" if new_index else "aborted"  # live index left as it was
+    else:
+        ensure_index(es)
+        with refresh_disabled(es):
+            count, errors = bulk_index(es, make_actions(clear_passages=INDEX_GRANULARITY == "passage"), job=job)
+        errors += delete_errors
+        status = "ok" if not errors else "partial"
+    elapsed = time.perf_counter() - started
+
+    # Every document may have been rewritten
+    ANSWER_CACHE.clear()
+
+    return {
+        "status": status,
+        "mode": mode,
+        **generation,
+        "indexed": count,
+        "failed": len(errors),
+        "errors": errors[:ES_BULK_ERROR_SAMPLE],
+        "throughput": {
+            "seconds": round(elapsed, 2),
+            "docs_per_s": round(count / elapsed, 1) if elapsed else None,
+            "batches": stats.get("batches", 0),
+            "retries": stats.get("retries", 0)
+        },
+        "embedding_cache": {
+            "hits": stats.get("cache_hits", 0),
+            "misses": stats.get("cache_misses", 0),
+            "lifetime": EMBEDDING_CACHE.stats()
+        }
+    }
 
-    rows = get_mysql_rows()
-    count = 0
 
-    for row in rows:
-        text = f"{row['title']} {row['content']}"
-        embedding = generate_embedding(text)
-        index_document(es, row, embedding)
-        count += 1
+def submit_index_job(kind: str, fn, params: dict):
+    """Start an index-writing job; only one may run at a time."""
+    try:
+        job = JOB_RUNNER.submit(kind, fn, params)
+    except JobConflict as e:
+        raise HTTPException(status_code=409, detail={"error": str(e), "job_id": e.running.id})
+    return {"job_id": job.id, "status": job.status, "progress_url": f"/jobs/{job.id}"}
+
+
+@app.post("/build_index", status_code=202)
+def build_index(mode: Literal["inplace", "bluegreen"] = "inplace"):
+    if mode == "bluegreen":
+        require_elasticsearch("Blue/green builds")
+    return submit_index_job("build_index", lambda job: run_build_index(job, mode), {"mode": mode})
+
+
+@app.get("/index/generations")
+def list_generations():
+    require_elasticsearch("Index generations")
+    es = get_es()
+    return {"alias": ES_INDEX, "live": alias_targets(es), "generations": index_generations(es)}
 
-    es.indices.refresh(index=ES_INDEX)
-    return {"status": "ok", "indexed": count}
+
+@app.post("/index/rollback")
+def rollback_index():
+    """
+    Point the alias back at the generation built before the live one, and
+    delete the generation rolled back from so that neither later retention
+    nor a second rollback ever picks it over a known-good one.
+    """
+    require_elasticsearch("Index rollback")
+    es = get_es()
+    live = alias_targets(es)
+    generations = index_generations(es)
+    older = [name for name in generations if live and name < live[0]]
+    if not older:
+        raise HTTPException(status_code=409, detail="No previous index generation to roll back to")
+
+    point_alias(es, older[-1])
+    discarded = [name for name in live if name in generations]
+    if discarded:
+        es.indices.delete(index=",".join(discarded))
+    ANSWER_CACHE.clear()
+    return {"status": "ok", "live": older[-1], "previous": live, "discarded": discarded}
 
 
 # ====================================================================
 # ✅ API 2 : SYNC + ANSWER
 # ====================================================================
 
-@app.get("/sync")
-def sync_database():
-
-    # === Fetch all MySQL IDs ===
-    conn = mysql.connector.connect(**DB_CONFIG)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM questions WHERE status='publish'")
-    mysql_ids = {row[0] for row in cursor.fetchall()}
-    cursor.close()
-    conn.close()
-
-    # === Fetch all Elasticsearch IDs ===
-    es = Elasticsearch([f"http://{ES_HOST}:{ES_PORT}"])
-    resp = es.search(index=ES_INDEX, size=10000, _source=False, query={"match_all": {}})
-
-    es_ids = {int(hit["_id"]) for hit in resp["hits"]["hits"]}
-
-    # Compute differences
-    to_delete = es_ids - mysql_ids
-    to_add = mysql_ids - es_ids
-
-    # Delete
-    for doc_id in to_delete:
-        es.delete(index=ES_INDEX, id=doc_id, ignore=[404])
-
-    # Add missing rows
-    if to_add:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor(dictionary=True)
-        format_ids = ",".join(str(i) for i in to_add)
-
-        cursor.execute(f"""
-            SELECT id, title, content, post_type, langues, ecoles
-            FROM questions
-            WHERE id IN ({format_ids})
-        """)
-        
-        rows = cursor.fetchall()
-        for row in rows:
-            text = f"{row['title']} {row['content']}"
-            embedding = generate_embedding(text)
-            index_document(es, row, embedding)
+def run_sync(job, full: bool = False):
+    """
+    Incremental sync. Deletes documents no longer published, then re-embeds
+    only rows that are new or whose text changed. By default only rows
+    edited since the index's high-water mark (max updated_at) are compared;
+    full=true compares the content hash of every published row.
+    With VECTOR_BACKEND=local, rewrites the local index reusing unchanged vectors.
+    """
+    if VECTOR_BACKEND == "local":
+        return run_local_index(job, incremental=not full)
 
+    es = get_es()
+    ensure_index(es)
+
+    # === Indexed state: id -> content hash ===
+    es_hashes = dict(iter_index_state(es))
+    high_water = None if full else index_high_water_mark(es)
+
+    # === Published ids, and the ones edited since the high-water mark ===
+    with mysql_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, updated_at FROM questions WHERE status='publish'")
+        mysql_updated = dict(cursor.fetchall())
         cursor.close()
-        conn.close()
+
+    mysql_ids = set(mysql_updated)
+    to_delete = set(es_hashes) - mysql_ids
+
+    if high_water is None:
+        candidates = mysql_ids
+    else:
+        since = high_water - SYNC_WATERMARK_SLACK
+        candidates = {
+            doc_id for doc_id, updated_at in mysql_updated.items()
+            if doc_id not in es_hashes          # new
+            or es_hashes[doc_id] is None        # indexed before hashes existed
+            or updated_at is None
+            or updated_at >= since              # edited since last sync
+        }
+
+    job.set_total(len(candidates), counter="read")
+
+    # Delete in bulk
+    deleted, errors = delete_questions(es, to_delete)
+
+    # Re-embed rows whose text actually changed: fetch, embed and index run
+    # as a pipeline, one bounded chunk of ids at a time
+    changed_ids = set()
+
+    def changed_rows():
+        for rows in iter_rows_by_ids(candidates):
+            job.advance(read=len(rows))
+            rows = [row for row in rows if es_hashes.get(row['id']) != row_hash(row)]
+            changed_ids.update(row['id'] for row in rows)
+            if INDEX_GRANULARITY == "passage":
+                # An edited answer may now split into fewer passages: drop the old ones first
+                stale = [row['id'] for row in rows if row['id'] in es_hashes]
+                if stale:
+                    _, stale_errors = delete_questions(es, stale)
+                    errors.extend(stale_errors)
+                rows = [unit for row in rows for unit in index_units(row)]
+            yield rows
+
+    embed_stats = {}
+    embedded = prefetch(embed_row_chunks(changed_rows(), embed_stats, job))
+    _, index_errors = bulk_index(es, embedded_index_actions(embedded), job=job)
+    errors += index_errors
 
     es.indices.refresh(index=ES_INDEX)
 
+    failed_ids = {question_id(e["id"]) for e in index_errors if e.get("id") is not None}
+    added = changed_ids - set(es_hashes)
+    ANSWER_CACHE.invalidate_ids(to_delete | changed_ids)
+
     return {
-        "status": "ok",
-        "deleted": len(to_delete),
-        "added": len(to_add)
+        "status": "ok" if not errors else "partial",
+        "mode": "full" if high_water is None else "incremental",
+        "high_water_mark": high_water.isoformat() if high_water else None,
+        "checked": len(candidates),
+        "deleted": deleted,
+        "added": len(added - failed_ids),
+        "updated": len(changed_ids - added - failed_ids),
+        "unchanged": len(candidates) - len(changed_ids),
+        "failed": len(errors),
+        "errors": errors[:ES_BULK_ERROR_SAMPLE],
+        "embedding": embed_stats
     }
 
 
+@app.get("/sync", status_code=202)
+def sync_database(full: bool = False):
+    return submit_index_job("sync", lambda job: run_sync(job, full), {"full": full})
+
+
 # ====================================================================
 # ✅ API 2 (suite) : SEARCH
 # ====================================================================
 
 @app.post("/ask")
-def ask_question(payload: QuestionRequest):
-    print("\n" + "="*60)
-    print("[START] ask_question called")
-    print("="*60)
+async def ask_question(payload: QuestionRequest, request: Request):
+    # Stop spending OpenAI/ES time on a client that has already hung up
+    try:
+        return await run_until_disconnected(request, answer_question(payload))
+    except ClientDisconnected:
+        log.info("Client disconnected, request cancelled")
+        return Response(status_code=499)
+
 
+async def retrieve_matches(payload: QuestionRequest):
+    """Steps 1-4 of /ask: embed the question and fetch the top_k matches. Returns (matches, embedding_cached)."""
     query = payload.message
     top_k = payload.top_k
+    mode = payload.search_mode or ASK_SEARCH_MODE
+
+    filters = search_filters(payload.language, payload.school, payload.category)
+    hybrid = hybrid_params(payload) if mode == "hybrid" else None
+    if verbose(log):
+        log.debug("Retrieving matches", extra={"fields": {
+            "query": query,
+            "top_k": top_k,
+            "search_mode": mode,
+            "filters": filters,
+            "hybrid": hybrid
+        }})
+
+    # STEP 1: shared vector store (Elasticsearch client or local mmap index)
+    with stage_timer("es_connect"):
+        store = get_vector_store()
+
+    # STEP 2: query embedding
+    with stage_timer("query_embedding"):
+        query_embedding, embedding_cached = await with_timeout(embed_query(query), ASK_EMBED_TIMEOUT, "Query embedding")
+
+    # STEP 3-4: vector search -> matches
+    # Passage index: fetch several passages per wanted match, then collapse
+    # them to their question, keeping its best passages as the answer
+    passages = INDEX_GRANULARITY == "passage"
+    with stage_timer("vector_search"):
+        matches = await with_timeout(
+            store.search(query_embedding, top_k * PASSAGE_OVERSAMPLE if passages else top_k,
+                         filters, mode, payload.num_candidates, query, hybrid),
+            ASK_SEARCH_TIMEOUT,
+            "Vector search"
+        )
+    if passages:
+        matches = collapse_passages(matches, top_k, LLM_MAX_PASSAGES)
+    # The stores score (1 + cosine) / 2; /ask reports 1 + cosine, which the
+    # frontend and the feedback similarity_score expect
+    for match in matches:
+        if match.get("score") is not None:
+            match["score"] *= 2
+    log.debug("Retrieved %d matches (embedding cached: %s)", len(matches), embedding_cached)
+    return matches, embedding_cached
+
+
+async def answer_question(payload: QuestionRequest):
+    query = payload.message
     use_llm = payload.use_llm
 
-    print(f"[DEBUG] Query: {query}")
-    print(f"[DEBUG] Top K: {top_k}")
-    print(f"[DEBUG] Use LLM: {use_llm}")
-
-    print("\n[STEP 1] Connecting to Elasticsearch...")
-    es = Elasticsearch([f"http://{ES_HOST}:{ES_PORT}"])
-    print(f"[DEBUG] Connected to Elasticsearch at {ES_HOST}:{ES_PORT}")
-
-    print("\n[STEP 2] Generating query embedding...")
-    query_embedding = generate_embedding(query)
-    print(f"[DEBUG] Embedding generated (length: {len(query_embedding)})")
-
-    print("\n[STEP 3] Searching Elasticsearch...")
-    results = es.search(
-        index=ES_INDEX,
-        size=top_k,
-        query={
-            "script_score": {
-                "query": {"match_all": {}},
-                "script": {
-                    "source": "cosineSimilarity(params.query_vector, 'embedding') + 1.0",
-                    "params": {"query_vector": query_embedding}
-                }
-            }
-        },
-        _source=["id", "question", "answer", "category"]
-    )
-    print(f"[DEBUG] Search complete. Found {len(results['hits']['hits'])} results")
-
-    print("\n[STEP 4] Processing matches...")
-    matches = [
-        {
-            "score": hit["_score"],
-            "id": hit["_source"]["id"],
-            "question": hit["_source"]["question"],
-            "answer": hit["_source"]["answer"],
-        }
-        for hit in results['hits']['hits']
-    ]
-    print(f"[DEBUG] Processed {len(matches)} matches")
+    matches, embedding_cached = await retrieve_matches(payload)
 
     # If LLM processing is enabled, use it to synthesize the best answer
     if use_llm and matches:
-        print("\n[STEP 5] Calling LLM to process results...")
-        result = llm_process_results(query, matches)
-        print("[DEBUG] LLM processing complete")
-        print("="*60)
-        print("[END] Returning LLM-processed response")
-        print("="*60 + "\n")
+        answer_key = AnswerCache.make_key(query, matches)
+        cached_answer = ANSWER_CACHE.get(answer_key)
+
+        # STEP 5: LLM answer, cached or synthesized
+        if cached_answer is not None:
+            result = copy.deepcopy(cached_answer)
+        else:
+            result = await llm_process_results(query, matches)
+            # Error fallbacks are not worth remembering
+            if "error" not in result:
+                ANSWER_CACHE.put(answer_key, copy.deepcopy(result))
+
+        result.setdefault("meta", {})["cache"] = {
+            "answer_hit": cached_answer is not None,
+            "embedding_hit": embedding_cached
+        }
+        log.info("Answered with LLM", extra={"fields": {
+            "matches": len(matches),
+            "answer_cache_hit": cached_answer is not None,
+            "embedding_cache_hit": embedding_cached
+        }})
         return result
 
     # Otherwise, return raw matches (original behavior)
-    print("\n[STEP 5] Returning raw matches (no LLM)")
-    print("="*60)
-    print("[END] Returning raw response")
-    print("="*60 + "\n")
+    log.info("Answered with raw matches", extra={"fields": {
+        "matches": len(matches),
+        "embedding_cache_hit": embedding_cached
+    }})
     return {
         "matches": matches,
         "llm_processed": False
     }
+
+
+# ====================================================================
+# ✅ API 2 (suite) : STREAMING SEARCH (SSE)
+# ====================================================================
+
+def sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def stream_llm_answer(user_query: str, matches: list):
+    """
+    Streaming counterpart of llm_process_results: yields ("token", text)
+    pieces of answer_html while the completion is generated, then
+    ("final", result_json) with citations enriched.
+    """
+    extractor = AnswerHtmlExtractor()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + ASK_LLM_TIMEOUT
+
+    try:
+        with stage_timer("llm_synthesis"):
+            stream = await asyncio.wait_for(
+                get_async_openai().chat.completions.create(
+                    model=LLM_MODEL,
+                    messages=build_llm_messages(user_query, matches),
+                    temperature=0.2,
+                    max_tokens=LLM_MAX_TOKENS,
+                    response_format={"type": "json_object"},
+                    stream=True,
+                    stream_options={"include_usage": True}  # usage arrives in a last, choice-less chunk
+                ),
+                timeout=ASK_LLM_TIMEOUT
+            )
+            # The budget covers the whole generation, not each chunk
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(stream.__anext__(), timeout=max(deadline - loop.time(), 0))
+                except StopAsyncIteration:
+                    break
+                record_usage(LLM_MODEL, chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = extractor.feed(chunk.choices[0].delta.content or "")
+                if delta:
+                    yield "token", delta
+
+        result_json = parse_llm_content(extractor.text.strip(), user_query, matches)
+        with stage_timer("citation_enrichment"):
+            enrich_citations(result_json, matches)
+    except Exception as e:
+        result_json = llm_error_fallback(user_query, matches, e)
+
+    yield "final", result_json
+
+
+async def stream_answer_events(payload: QuestionRequest):
+    """
+    SSE events for /ask/stream: "matches" as soon as retrieval is done,
+    "token" events carrying answer_html as it is generated, then "final"
+    with the same JSON /ask would return. Starlette cancels this generator
+    when the client disconnects.
+    """
+    query = payload.message
+
+    try:
+        matches, embedding_cached = await retrieve_matches(payload)
+    except HTTPException as e:
+        yield sse("error", {"status": e.status_code, "detail": e.detail})
+        return
+
+    yield sse("matches", {"matches": matches})
+
+    if not payload.use_llm:
+        yield sse("final", {"matches": matches, "llm_processed": False})
+        return
+    if not matches:
+        yield sse("final", no_match_response(query))
+        return
+
+    answer_key = AnswerCache.make_key(query, matches)
+    cached_answer = ANSWER_CACHE.get(answer_key)
+
+    if cached_answer is not None:
+        result = copy.deepcopy(cached_answer)
+        yield sse("token", {"delta": result.get("answer_html", "")})
+    else:
+        async for kind, value in stream_llm_answer(query, matches):
+            if kind == "token":
+                yield sse("token", {"delta": value})
+            else:
+                result = value
+        if "error" not in result:
+            ANSWER_CACHE.put(answer_key, copy.deepcopy(result))
+
+    result.setdefault("meta", {})["cache"] = {
+        "answer_hit": cached_answer is not None,
+        "embedding_hit": embedding_cached
+    }
+    yield sse("final", result)
+
+
+@app.post("/ask/stream")
+async def ask_question_stream(payload: QuestionRequest):
+    return StreamingResponse(
+        stream_answer_events(payload),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# ====================================================================
+# ✅ API 3 : KNN TUNING REPORT
+# ====================================================================
+
+def percentile(values: list, pct: float):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def timed_search(es, top_k: int, params: dict):
+    started = time.perf_counter()
+    results = await es.search(index=ES_INDEX, size=top_k, _source=False, **params)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    return [hit["_id"] for hit in results["hits"]["hits"]], elapsed_ms
+
+
+@app.post("/search/knn_report")
+async def knn_report(payload: KnnReportRequest):
+    """
+    Compare approximate kNN against the exact scan for a set of sample
+    questions: recall@top_k and latency for each num_candidates setting.
+    """
+    require_elasticsearch("The kNN report")
+    es = get_async_es()
+    embeddings = [(await embed_query(q))[0] for q in payload.queries]
+
+    exact_ids = []
+    exact_latencies = []
+    for embedding in embeddings:
+        ids, ms = await timed_search(es, payload.top_k, vector_search_params(embedding, payload.top_k, "exact"))
+        exact_ids.append(set(ids))
+        exact_latencies.append(ms)
+
+    settings = []
+    for candidates in sorted(set(payload.num_candidates)):
+        recalls = []
+        latencies = []
+        for embedding, expected in zip(embeddings, exact_ids):
+            ids, ms = await timed_search(es, payload.top_k, vector_search_params(embedding, payload.top_k, "knn", candidates))
+            recalls.append(len(expected & set(ids)) / len(expected) if expected else 1.0)
+            latencies.append(ms)
+        settings.append({
+            "num_candidates": max(candidates, payload.top_k),
+            "recall": round(sum(recalls) / len(recalls), 4),
+            "min_recall": round(min(recalls), 4),
+            "latency_ms_p50": round(percentile(latencies, 50), 2),
+            "latency_ms_p95": round(percentile(latencies, 95), 2)
+        })
+
+    return {
+        "queries": len(payload.queries),
+        "top_k": payload.top_k,
+        "exact": {
+            "latency_ms_p50": round(percentile(exact_latencies, 50), 2),
+            "latency_ms_p95": round(percentile(exact_latencies, 95), 2)
+        },
+        "knn": settings
+    }
+
+
+# ====================================================================
+# ✅ API 4 : BACKGROUND JOBS
+# ====================================================================
+
+def find_job(job_id: str):
+    job = JOB_RUNNER.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return job
+
+
+@app.get("/jobs")
+def list_jobs():
+    return {"jobs": [job.to_dict() for job in JOB_RUNNER.list()]}
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    return find_job(job_id).to_dict()
+
+
+@app.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    job = find_job(job_id)
+    job.cancel()
+    return job.to_dict()
+
+
+# ====================================================================
+# ✅ API 5 : METRICS + CACHE STATS
+# ====================================================================
+
+@app.get("/metrics")
+def metrics():
+    body, content_type = render_latest()
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {
+        "query_embeddings": QUERY_EMBEDDING_CACHE.stats(),
+        "document_embeddings": EMBEDDING_CACHE.stats(),
+        "answers": ANSWER_CACHE.stats()
+    }
+
+
+@app.get("/health")
+def health():
+    status = check_clients()
+    if any(value != "ok" for value in status.values()):
+        raise HTTPException(status_code=503, detail=status)
+    return {"status": "ok", **status, "retrieval": get_vector_store().describe()}
@@ -0,0 +1,162 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+# ====================================================================
+# BACKGROUND JOBS (/build_index, /sync)
+# ====================================================================
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobConflict(Exception):
+    """Raised when an exclusive job is submitted while another one runs."""
+
+    def __init__(self, running):
+        super().__init__(f"Job {running.id} ({running.kind}) is already running")
+        self.running = running
+
+
+class Job:
+    """
+    One background run. Pipeline stages report progress through advance()
+    and call check_cancelled() between chunks so a cancel takes effect at
+    the next chunk boundary.
+    """
+
+    COUNTERS = ("read", "embedded", "indexed", "failed")
+
+    def __init__(self, kind: str, params: dict = None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params or {}
+        self.status = "queued"  # queued -> running -> succeeded | failed | cancelled
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.total = None
+        self.progress_counter = "indexed"
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+
+    def set_total(self, total: int, counter: str = "indexed"):
+        """Expected final value of `counter`, which drives the ETA."""
+        self.total = total
+        self.progress_counter = counter
+
+    def advance(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                self.counters[name] += value
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancel_requested(self) -> bool:
+        return self._cancel.is_set()
+
+    def check_cancelled(self):
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def eta_seconds(self):
+        """Remaining time extrapolated from the progress rate so far."""
+        if self.status != "running" or not self.total or not self.started_at:
+            return None
+        done = self.counters[self.progress_counter]
+        if self.progress_counter == "indexed":
+            done += self.counters["failed"]
+        if not done:
+            return None
+        elapsed = time.time() - self.started_at
+        return round(max(self.total - done, 0) * elapsed / done, 1)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "params": self.params,
+            "status": self.status,
+            "cancel_requested": self.cancel_requested,
+            "total": self.total,
+            "progress": counters,
+            "eta_seconds": self.eta_seconds(),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error
+        }
+
+
+class JobRunner:
+    """
+    Runs jobs on a small thread pool and remembers the last `keep` of them.
+    Exclusive jobs share one lock: an index rebuild and a sync never overlap.
+    """
+
+    def __init__(self, max_workers: int = 2, keep: int = 50):
+        self.keep = keep
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = OrderedDict()
+        self._jobs_lock = threading.Lock()
+        self._exclusive_lock = threading.Lock()
+        self._exclusive_job = None  # the running exclusive job, read and written under _exclusive_lock
+
+    def submit(self, kind: str, fn, params: dict = None, exclusive: bool = True) -> Job:
+        """Schedule fn(job) in the background and return the job right away."""
+        job = Job(kind, params)
+
+        if exclusive:
+            with self._exclusive_lock:
+                if self._exclusive_job is not None:
+                    raise JobConflict(self._exclusive_job)
+                self._exclusive_job = job
+
+        with self._jobs_lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.keep:
+                self._jobs.popitem(last=False)
+
+        self._executor.submit(self._run, job, fn, exclusive)
+        return job
+
+    def _run(self, job: Job, fn, exclusive: bool):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            job.result = fn(job)
+            job.status = "succeeded"
+        except JobCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e) or type(e).__name__
+        finally:
+            job.finished_at = time.time()
+            if exclusive:
+                with self._exclusive_lock:
+                    self._exclusive_job = None
+
+    def get(self, job_id: str):
+        with self._jobs_lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> list:
+        with self._jobs_lock:
+            return list(reversed(self._jobs.values()))
+
+    def shutdown(self):
+        for job in self.list():
+            job.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
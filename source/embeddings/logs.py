@@ -0,0 +1,116 @@
+import contextvars
+import json
+import logging
+import random
+import sys
+import time
+import uuid
+
+
+# ====================================================================
+# STRUCTURED LOGGING (one JSON object per line)
+# ====================================================================
+
+REQUEST_ID = contextvars.ContextVar("request_id", default=None)
+_SAMPLED = contextvars.ContextVar("log_sampled", default=True)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Renders a record as one JSON line: ts, level, logger, msg, the current
+    request id, then whatever was passed as extra={"fields": {...}}.
+    """
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        request_id = REQUEST_ID.get()
+        if request_id:
+            entry["request_id"] = request_id
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Drops DEBUG/INFO records of requests left out of the sample; warnings and errors always pass."""
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or _SAMPLED.get()
+
+
+def setup_logging(name: str, level: str = "INFO") -> logging.Logger:
+    logger = logging.getLogger(name)
+    logger.setLevel(level.upper())
+    logger.propagate = False
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(JsonFormatter())
+        logger.addHandler(handler)
+        logger.addFilter(SamplingFilter())
+    return logger
+
+
+def start_request(request_id: str = None, sample_rate: float = 1.0) -> str:
+    """
+    Bind a request id (the caller's, or a fresh one) to the current context
+    and decide once whether this request's DEBUG/INFO lines are kept, so a
+    sampled request is always logged in full.
+    """
+    request_id = request_id or uuid.uuid4().hex
+    REQUEST_ID.set(request_id)
+    _SAMPLED.set(sample_rate >= 1 or random.random() < sample_rate)
+    return request_id
+
+
+def verbose(logger: logging.Logger, level: int = logging.DEBUG) -> bool:
+    """
+    True when a record at `level` would actually be written. Guard any log
+    payload that is costly to build (json.dumps of citations, id lists...)
+    with it so nothing is serialized when it would be thrown away.
+    """
+    return logger.isEnabledFor(level) and _SAMPLED.get()
+
+
+class RequestLogMiddleware:
+    """
+    Plain ASGI middleware (no response buffering, so SSE streams and
+    disconnect polling are untouched): binds the request id, echoes it as
+    X-Request-ID and logs one access line once the response is finished.
+    """
+
+    def __init__(self, app, logger: logging.Logger, sample_rate: float = 1.0):
+        self.app = app
+        self.logger = logger
+        self.sample_rate = sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        caller_id = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")
+        request_id = start_request(caller_id or None, self.sample_rate)
+        start = time.perf_counter()
+        status = None
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            self.logger.info("%s %s", scope["method"], scope["path"], extra={"fields": {
+                "status": status,
+                "duration_ms": round((time.perf_counter() - start) * 1000, 1)
+            }})
@@ -0,0 +1,89 @@
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+
+# ====================================================================
+# PROMETHEUS METRICS (/metrics)
+# ====================================================================
+
+# /ask stages, in pipeline order
+STAGES = ("es_connect", "query_embedding", "vector_search", "llm_synthesis", "citation_enrichment")
+
+STAGE_LATENCY = Histogram(
+    "rag_stage_seconds",
+    "Latency of each /ask pipeline stage",
+    ["stage"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+
+OPENAI_TOKENS = Counter(
+    "rag_openai_tokens",
+    "Tokens billed by OpenAI, from the usage block of each response",
+    ["model", "kind"]  # kind: prompt | completion
+)
+
+CONTEXT_TOKENS = Histogram(
+    "rag_context_tokens",
+    "Excerpt tokens per LLM call: the full answers (original) and what the context budget kept (sent)",
+    ["kind"],
+    buckets=(50, 100, 200, 400, 800, 1200, 1600, 2400, 3200, 4800, 6400, 9600)
+)
+
+for _stage in STAGES:
+    STAGE_LATENCY.labels(_stage)  # export every stage from the start, even before traffic
+
+
+def stage_timer(stage: str):
+    """Context manager observing the wrapped block into rag_stage_seconds{stage}."""
+    return STAGE_LATENCY.labels(stage).time()
+
+
+def record_usage(model: str, usage):
+    """Count prompt/completion tokens from an OpenAI response's usage (may be None)."""
+    if usage is None:
+        return
+    prompt = getattr(usage, "prompt_tokens", None)
+    completion = getattr(usage, "completion_tokens", None)
+    if prompt:
+        OPENAI_TOKENS.labels(model, "prompt").inc(prompt)
+    if completion:
+        OPENAI_TOKENS.labels(model, "completion").inc(completion)
+
+
+def record_context(stats: dict):
+    CONTEXT_TOKENS.labels("original").observe(stats["original_tokens"])
+    CONTEXT_TOKENS.labels("sent").observe(stats["context_tokens"])
+
+
+class CacheStatsCollector:
+    """Exports hits, misses, size and hit rate of every cache exposing stats()."""
+
+    def __init__(self, caches: dict):
+        self.caches = caches
+
+    def collect(self):
+        hits = CounterMetricFamily("rag_cache_hits", "Cache hits", labels=["cache"])
+        misses = CounterMetricFamily("rag_cache_misses", "Cache misses", labels=["cache"])
+        entries = GaugeMetricFamily("rag_cache_entries", "Entries currently cached", labels=["cache"])
+        hit_rate = GaugeMetricFamily("rag_cache_hit_rate", "Lifetime hit rate", labels=["cache"])
+
+        for name, cache in self.caches.items():
+            stats = cache.stats()
+            hits.add_metric([name], stats["hits"])
+            misses.add_metric([name], stats["misses"])
+            entries.add_metric([name], stats["entries"])
+            hit_rate.add_metric([name], stats["hit_rate"] or 0.0)
+
+        yield hits
+        yield misses
+        yield entries
+        yield hit_rate
+
+
+def register_caches(caches: dict):
+    REGISTRY.register(CacheStatsCollector(caches))
+
+
+def render_latest():
+    """(body, content_type) for the /metrics endpoint."""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
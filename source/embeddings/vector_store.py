@@ -0,0 +1,517 @@
+import glob
+import json
+import math
+import os
+import re
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from caches import normalize_query
+
+
+# ====================================================================
+# VECTOR STORES (retrieval backends behind /ask)
+# ====================================================================
+
+# --------------------------------------------------------------------
+# Hybrid retrieval: BM25 + vector, fused
+# --------------------------------------------------------------------
+
+BM25_FIELDS = {"question": 2.0, "answer": 1.0}  # field -> boost, best field wins (multi_match best_fields)
+
+
+def term_filters(filters: dict) -> list:
+    """{field: value} as Elasticsearch term clauses."""
+    return [{"term": {field: value}} for field, value in (filters or {}).items()]
+
+
+def bm25_query(text: str, filters: dict = None) -> dict:
+    return {
+        "bool": {
+            "must": {"multi_match": {"query": text, "fields": [f"{f}^{boost:g}" for f, boost in BM25_FIELDS.items()]}},
+            "filter": term_filters(filters)
+        }
+    }
+
+
+def fuse(legs: list, top_k: int, method: str = "rrf", rrf_k: int = 60) -> list:
+    """
+    Merge ranked match lists [(weight, matches best first), ...] into one.
+    rrf: sum of weight / (rrf_k + rank), robust to incomparable score scales.
+    weighted: sum of weight * score min-max normalized within its list.
+    The fused value replaces each match's score.
+    """
+    fused = {}
+    found = {}
+    for weight, matches in legs:
+        if not matches:
+            continue
+        high, low = matches[0]["score"], matches[-1]["score"]
+        for rank, match in enumerate(matches, start=1):
+            key = (str(match["id"]), match.get("passage"))
+            found.setdefault(key, match)
+            if method == "weighted":
+                contribution = weight * ((match["score"] - low) / (high - low) if high > low else 1.0)
+            else:
+                contribution = weight / (rrf_k + rank)
+            fused[key] = fused.get(key, 0.0) + contribution
+
+    best = sorted(fused, key=fused.get, reverse=True)[:top_k]
+    return [{**found[key], "score": fused[key]} for key in best]
+
+
+def fuse_hybrid(bm25_matches: list, vector_matches: list, top_k: int, hybrid: dict) -> list:
+    """
+    fuse() the BM25 and vector rankings as configured by hybrid, keeping the
+    vector similarity in score (None for BM25-only hits) and the fused value
+    in fusion_score.
+    """
+    similarity = {(str(match["id"]), match.get("passage")): match["score"] for match in vector_matches}
+    matches = fuse(
+        [(hybrid["bm25_weight"], bm25_matches), (hybrid["vector_weight"], vector_matches)],
+        top_k, hybrid["method"], hybrid["rrf_k"]
+    )
+    for match in matches:
+        match["fusion_score"] = match["score"]
+        match["score"] = similarity.get((str(match["id"]), match.get("passage")))
+    return matches
+
+
+# --------------------------------------------------------------------
+# Passage-level indexing: one document per passage of an answer
+# --------------------------------------------------------------------
+
+def document_match(score: float, doc: dict) -> dict:
+    """A search hit as a match; passage documents also carry passage and overlap."""
+    match = {"score": score, "id": doc["id"], "question": doc["question"], "answer": doc["answer"]}
+    if doc.get("passage") is not None:
+        match["passage"] = doc["passage"]
+        match["overlap"] = doc.get("overlap") or 0
+    return match
+
+
+def collapse_passages(matches: list, top_k: int, max_passages: int = 3) -> list:
+    """
+    Passage hits (best first) collapsed to their parent question: one match
+    per id, scored by its best passage, whose answer is its best
+    max_passages passages rejoined in article order, overlaps removed and
+    "…" marking gaps. Matches without a passage are kept as they are.
+    """
+    parents = {}
+    for match in matches:
+        parent = parents.get(match["id"])
+        if parent is None:
+            if len(parents) == top_k:
+                continue
+            parent = parents[match["id"]] = {**match, "passages": []}
+        if match.get("passage") is not None and len(parent["passages"]) < max_passages:
+            parent["passages"].append(match)
+
+    collapsed = []
+    for parent in parents.values():
+        passages = sorted(parent.pop("passages"), key=lambda m: m["passage"])
+        parent.pop("overlap", None)
+        if parent.pop("passage", None) is not None:
+            parts = ["…"] if passages[0]["passage"] else []
+            previous = None
+            for passage in passages:
+                if previous is not None and passage["passage"] == previous + 1:
+                    parts.append(passage["answer"][passage["overlap"]:])
+                else:
+                    if previous is not None:
+                        parts.append("…")
+                    parts.append(passage["answer"])
+                previous = passage["passage"]
+            parent["answer"] = " ".join(part for part in parts if part)
+            parent["passages"] = [passage["passage"] for passage in passages]
+        collapsed.append(parent)
+    return collapsed
+
+
+# ====================================================================
+# STORES
+# ====================================================================
+
+class VectorStore:
+    """
+    Retrieval backend. search() returns up to top_k matches, best first, as
+    {"score", "id", "question", "answer"} with score = (1 + cosine) / 2;
+    hits on passage documents add "passage" and "overlap".
+    filters maps a document field (category, language, schools) to the
+    value it must hold; a list field matches when it contains the value.
+
+    mode="hybrid" also runs a BM25 query on query_text and fuses both
+    rankings as described by hybrid: {"method", "rrf_k", "window",
+    "bm25_weight", "vector_weight"}; each side returns `window` candidates.
+    Results are in fused order; score stays the vector similarity (None for
+    hits only BM25 found) and fusion_score holds the fused value.
+    """
+
+    name = None
+
+    async def search(self, query_embedding: list, top_k: int, filters: dict = None, mode: str = None,
+                     num_candidates: int = None, query_text: str = None, hybrid: dict = None) -> list:
+        raise NotImplementedError
+
+    def describe(self) -> dict:
+        return {"backend": self.name}
+
+
+class ElasticsearchStore(VectorStore):
+    """The ES index: approximate kNN or exact script_score, per search_params."""
+
+    name = "elasticsearch"
+    SOURCE = ["id", "question", "answer", "category", "passage", "overlap"]
+
+    def __init__(self, get_client, index: str, search_params):
+        self.get_client = get_client
+        self.index = index
+        self.search_params = search_params
+
+    async def search(self, query_embedding, top_k, filters=None, mode=None, num_candidates=None, query_text=None, hybrid=None):
+        if mode == "hybrid":
+            return await self.hybrid_search(query_embedding, top_k, filters, num_candidates, query_text, hybrid)
+
+        results = await self.get_client().search(
+            index=self.index,
+            size=top_k,
+            _source=self.SOURCE,
+            **self.search_params(query_embedding, top_k, mode, num_candidates, filters)
+        )
+        return self.matches(results)
+
+    async def hybrid_search(self, query_embedding, top_k, filters, num_candidates, query_text, hybrid):
+        """BM25 and kNN legs sent together in one _msearch round trip, fused client-side."""
+        window = max(hybrid["window"], top_k)
+        common = {"size": window, "_source": self.SOURCE}
+        results = await self.get_client().msearch(searches=[
+            {"index": self.index},
+            {**common, "query": bm25_query(query_text, filters)},
+            {"index": self.index},
+            {**common, **self.search_params(query_embedding, window, "knn", num_candidates, filters)},
+        ])
+
+        bm25, vector = results["responses"]
+        for leg in (bm25, vector):
+            if "error" in leg:
+                raise RuntimeError(f"Hybrid search failed: {leg['error']}")
+
+        return fuse_hybrid(self.matches(bm25), self.matches(vector), top_k, hybrid)
+
+    @staticmethod
+    def matches(results) -> list:
+        return [document_match(hit["_score"], hit["_source"]) for hit in results["hits"]["hits"]]
+
+    def describe(self):
+        return {"backend": self.name, "index": self.index}
+
+
+# --------------------------------------------------------------------
+# Local backend: a NumPy matrix memory-mapped from disk
+# --------------------------------------------------------------------
+# <path>/CURRENT                  name of the live generation
+# <path>/<gen>.vectors.npy        unit-normalized rows, float32 or int8
+# <path>/<gen>.scales.npy         int8 only: per-row dequantization scale
+# <path>/<gen>.docs.json          id, question, answer (or passage) and filter fields per row
+
+def _generation_file(path: str, generation: str, kind: str) -> str:
+    return os.path.join(path, f"{generation}.{kind}")
+
+
+def read_current(path: str):
+    try:
+        with open(os.path.join(path, "CURRENT")) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _replace_atomically(target: str, write):
+    tmp = f"{target}.tmp"
+    write(tmp)
+    os.replace(tmp, target)
+
+
+def write_local_index(path: str, documents: list, dims: int, dtype: str = "float32", keep: int = 2) -> str:
+    """
+    Write documents (build_document() output, embeddings of `dims` floats)
+    as a new generation, possibly empty, then publish it by rewriting
+    CURRENT. Readers switch on their next reload; older generations beyond
+    `keep` are removed.
+    Returns the generation name.
+    """
+    os.makedirs(path, exist_ok=True)
+    generation = f"{datetime.now(timezone.utc):%Y%m%d%H%M%S%f}"
+
+    matrix = np.asarray([doc["embedding"] for doc in documents], dtype=np.float32).reshape(len(documents), dims)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms == 0, 1, norms)
+
+    if dtype == "int8":
+        # Symmetric per-row quantization: row ~= int8 row * scale
+        scales = np.abs(matrix).max(axis=1) / 127
+        scales[scales == 0] = 1
+        quantized = np.round(matrix / scales[:, None]).astype(np.int8)
+        _replace_atomically(_generation_file(path, generation, "vectors.npy"), lambda tmp: _save(tmp, quantized))
+        _replace_atomically(_generation_file(path, generation, "scales.npy"), lambda tmp: _save(tmp, scales.astype(np.float32)))
+    else:
+        _replace_atomically(_generation_file(path, generation, "vectors.npy"), lambda tmp: _save(tmp, matrix))
+
+    docs = [{key: value for key, value in doc.items() if key != "embedding"} for doc in documents]
+
+    def write_docs(tmp):
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(docs, f, ensure_ascii=False, default=str)
+
+    _replace_atomically(_generation_file(path, generation, "docs.json"), write_docs)
+
+    def write_current(tmp):
+        with open(tmp, "w") as f:
+            f.write(generation)
+
+    _replace_atomically(os.path.join(path, "CURRENT"), write_current)
+
+    generations = sorted({os.path.basename(name).split(".")[0] for name in glob.glob(os.path.join(path, "*.docs.json"))})
+    for old in generations[:max(len(generations) - keep, 0)]:
+        for name in glob.glob(os.path.join(path, f"{old}.*")):
+            os.remove(name)
+
+    return generation
+
+
+def _save(target: str, array):
+    # np.save would append .npy to a name that does not end with it
+    with open(target, "wb") as f:
+        np.save(f, array)
+
+
+class _Snapshot:
+    """One generation: the mapped matrix plus per-row metadata and filter columns."""
+
+    def __init__(self, path: str, generation: str):
+        self.generation = generation
+        self.vectors = np.load(_generation_file(path, generation, "vectors.npy"), mmap_mode="r")
+        scales_file = _generation_file(path, generation, "scales.npy")
+        self.scales = np.load(scales_file, mmap_mode="r") if os.path.exists(scales_file) else None
+
+        with open(_generation_file(path, generation, "docs.json"), encoding="utf-8") as f:
+            self.docs = json.load(f)
+        self.columns = {
+            field: np.array([doc.get(field) for doc in self.docs], dtype=object)
+            for field in ("category", "language")
+        }
+        self._masks = {}
+        self._bm25 = None
+
+    def bm25(self, query_text: str):
+        """BM25 score of every row: the best boosted field, like multi_match best_fields."""
+        if self._bm25 is None:
+            self._bm25 = {field: BM25Field([doc.get(field) for doc in self.docs]) for field in BM25_FIELDS}
+        tokens = tokenize(query_text)
+        return np.maximum.reduce([boost * self._bm25[field].scores(tokens) for field, boost in BM25_FIELDS.items()])
+
+    def mask(self, filters: dict):
+        """Boolean row mask for the filters, or None when there are none."""
+        combined = None
+        for field, value in filters.items():
+            key = (field, value)
+            mask = self._masks.get(key)
+            if mask is None:
+                if field in self.columns:
+                    mask = self.columns[field] == value
+                else:
+                    mask = np.array([_holds(doc.get(field), value) for doc in self.docs], dtype=bool)
+                self._masks[key] = mask
+            combined = mask if combined is None else combined & mask
+        return combined
+
+    def scores(self, queries, block_rows: int):
+        """(rows, n_queries) cosine similarities of every row with every query."""
+        if self.scales is None:
+            return self.vectors @ queries.T
+        # int8 rows are upcast a block at a time to bound the temporary copy
+        out = np.empty((len(self.vectors), len(queries)), dtype=np.float32)
+        for start in range(0, len(self.vectors), block_rows):
+            block = self.vectors[start:start + block_rows].astype(np.float32)
+            out[start:start + block_rows] = (block @ queries.T) * self.scales[start:start + block_rows, None]
+        return out
+
+    def vector(self, row: int):
+        if self.scales is None:
+            return self.vectors[row]
+        return self.vectors[row].astype(np.float32) * self.scales[row]
+
+
+TOKEN_RE = re.compile(r"\w+")
+TAG_RE = re.compile(r"<[^>]+>")
+
+
+def tokenize(text: str) -> list:
+    """Lower-cased, accent-free words, HTML tags dropped (close to ES's standard analyzer)."""
+    return TOKEN_RE.findall(normalize_query(TAG_RE.sub(" ", text or "")))
+
+
+class BM25Field:
+    """Inverted index of one text field: term -> (rows, term frequencies)."""
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, texts: list):
+        postings = {}
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths[row] = len(tokens)
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                postings.setdefault(token, []).append((row, count))
+
+        self.size = len(texts)
+        self.norm = self.K1 * (1 - self.B + self.B * lengths / (lengths.mean() or 1))
+        self.postings = {
+            token: (np.array([r for r, _ in rows], dtype=np.int32), np.array([c for _, c in rows], dtype=np.float32))
+            for token, rows in postings.items()
+        }
+
+    def scores(self, tokens: list):
+        scores = np.zeros(self.size, dtype=np.float32)
+        for token in tokens:
+            posting = self.postings.get(token)
+            if posting is None:
+                continue
+            rows, tf = posting
+            idf = math.log(1 + (self.size - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += idf * tf * (self.K1 + 1) / (tf + self.norm[rows])
+        return scores
+
+
+def _holds(stored, value) -> bool:
+    return value in stored if isinstance(stored, list) else stored == value
+
+
+class LocalVectorStore(VectorStore):
+    """
+    Exact cosine search over a matrix memory-mapped read-only from disk.
+
+    Every worker process maps the same file, so the vectors live once in
+    the OS page cache and are never copied into a worker's heap. Scoring is
+    one matrix product for a batch of queries, then argpartition per query:
+    at help-center scale a search takes well under a millisecond. int8
+    quantization divides the file (and page cache) by four for a small loss
+    of precision. mode/num_candidates are ignored: the search is always
+    exact. A newly published generation is picked up at most
+    reload_interval seconds later. Hybrid mode adds an in-process BM25
+    index over question/answer, built on the first hybrid query.
+    """
+
+    name = "local"
+    BLOCK_ROWS = 8192
+
+    def __init__(self, path: str, reload_interval: float = 1.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._snapshot = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        """The live generation (None before the first build), reloaded when CURRENT changes."""
+        now = time.monotonic()
+        if self._checked_at is None or now - self._checked_at >= self.reload_interval:
+            with self._lock:
+                self._checked_at = now
+                generation = read_current(self.path)
+                if generation and (self._snapshot is None or self._snapshot.generation != generation):
+                    self._snapshot = _Snapshot(self.path, generation)
+        return self._snapshot
+
+    def search_many(self, query_embeddings: list, top_k: int, filters: dict = None) -> list:
+        """Top-k matches for each query of a batch, in one matrix product."""
+        snapshot = self.snapshot()
+        if snapshot is None or not len(snapshot.docs):
+            return [[] for _ in query_embeddings]
+
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms == 0, 1, norms)
+
+        scores = (snapshot.scores(queries, self.BLOCK_ROWS) + 1) / 2
+        mask = snapshot.mask(filters) if filters else None
+        if mask is not None:
+            scores[~mask] = -np.inf
+
+        k = min(top_k, len(snapshot.docs))
+        top = np.argpartition(-scores, k - 1, axis=0)[:k]
+
+        results = []
+        for j in range(len(queries)):
+            rows = top[:, j][np.argsort(-scores[top[:, j], j])]
+            results.append([
+                document_match(float(scores[row, j]), snapshot.docs[row])
+                for row in rows
+                if scores[row, j] != -np.inf
+            ])
+        return results
+
+    def keyword_search(self, query_text: str, top_k: int, filters: dict = None) -> list:
+        """Top-k rows by BM25 over question/answer; rows matching no query term are left out."""
+        snapshot = self.snapshot()
+        if snapshot is None or not len(snapshot.docs):
+            return []
+
+        scores = snapshot.bm25(query_text)
+        mask = snapshot.mask(filters) if filters else None
+        if mask is not None:
+            scores = np.where(mask, scores, 0)
+
+        k = min(top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return [
+            document_match(float(scores[row]), snapshot.docs[row])
+            for row in top[np.argsort(-scores[top])]
+            if scores[row] > 0
+        ]
+
+    async def search(self, query_embedding, top_k, filters=None, mode=None, num_candidates=None, query_text=None, hybrid=None):
+        if mode != "hybrid":
+            return self.search_many([query_embedding], top_k, filters)[0]
+
+        window = max(hybrid["window"], top_k)
+        return fuse_hybrid(
+            self.keyword_search(query_text, window, filters),
+            self.search_many([query_embedding], window, filters)[0],
+            top_k, hybrid
+        )
+
+    def stored_vectors(self) -> dict:
+        """
+        id -> (content_hash, [vector, ...]) of the live generation, for
+        incremental rebuilds: one vector per question, or one per passage
+        in passage order when the index holds passages.
+        """
+        snapshot = self.snapshot()
+        if snapshot is None:
+            return {}
+        stored = {}
+        for row, doc in enumerate(snapshot.docs):
+            stored.setdefault(doc["id"], (doc.get("content_hash"), []))[1].append((doc.get("passage") or 0, row))
+        return {
+            doc_id: (content_hash, [snapshot.vector(row) for _, row in sorted(rows)])
+            for doc_id, (content_hash, rows) in stored.items()
+        }
+
+    def describe(self):
+        snapshot = self.snapshot()
+        return {
+            "backend": self.name,
+            "path": self.path,
+            "generation": snapshot.generation if snapshot else None,
+            "documents": len(snapshot.docs) if snapshot else 0,
+            "dtype": str(snapshot.vectors.dtype) if snapshot else None
+        }